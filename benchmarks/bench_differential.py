@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import qiime2
+from q2_metnet._functional_analysis import differentialExchanges, differentialReactions, differentialSubSystems
+from q2_metnet._generateNetwork import _loadModel
+from .synthetic import availableReconstruction, syntheticScores, temporaryFolder
+
+class Differential:
+
+    ##########################################################################
+    # Differential methods over tables of increasing size, comparing two
+    # groups or all the pairs of four groups
+    ##########################################################################
+
+    params = ([1000, 20000], [10, 100, 1000], ["single", "all_pairwise"])
+    param_names = ["n_features", "n_samples", "contrasts"]
+    timeout = 1800
+
+    def setup(self, n_features, n_samples, contrasts):
+        availableReconstruction("SYNTHETIC", temporaryFolder())
+        self.n_groups = 2 if contrasts == "single" else 4
+        self.table, groups = syntheticScores(["feature%d" % x for x in range(n_features)], n_samples, self.n_groups)
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+
+    def time_differentialReactions(self, n_features, n_samples, contrasts):
+        differentialReactions(self.table, self.metadata, "group0", "group1", "SYNTHETIC", contrasts)
+
+    def peakmem_differentialReactions(self, n_features, n_samples, contrasts):
+        differentialReactions(self.table, self.metadata, "group0", "group1", "SYNTHETIC", contrasts)
+
+    def time_differentialSubSystems(self, n_features, n_samples, contrasts):
+        differentialSubSystems(self.table, self.metadata, "group0", "group1", contrasts)
+
+class DifferentialExchanges:
+
+    ##########################################################################
+    # differentialExchanges over the reactions of the synthetic
+    # reconstruction
+    ##########################################################################
+
+    params = ([10, 100, 1000], [True, False])
+    param_names = ["n_samples", "input_interest"]
+    timeout = 1800
+
+    def setup(self, n_samples, input_interest):
+        availableReconstruction("SYNTHETIC", temporaryFolder())
+        self.table, groups = syntheticScores(_loadModel("SYNTHETIC").rxnID, n_samples)
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+
+    def time_differentialExchanges(self, n_samples, input_interest):
+        differentialExchanges(self.table, self.metadata, "group0", "group1", "SYNTHETIC", input_interest)
+
+class Resampling:
+
+    ##########################################################################
+    # Permutation test and bootstrap intervals of the differential methods
+    ##########################################################################
+
+    params = ([1000, 20000], [1, 4])
+    param_names = ["n_features", "n_jobs"]
+    timeout = 3600
+
+    def setup(self, n_features, n_jobs):
+        self.table, groups = syntheticScores(["feature%d" % x for x in range(n_features)], 20)
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+
+    def time_permutations(self, n_features, n_jobs):
+        differentialSubSystems(self.table, self.metadata, "group0", "group1", permutations = 10000, n_jobs = n_jobs)
+
+    def time_bootstrap(self, n_features, n_jobs):
+        differentialSubSystems(self.table, self.metadata, "group0", "group1", bootstrap = 2000, n_jobs = n_jobs)
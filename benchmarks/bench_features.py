@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import pandas as pd
+import qiime2
+from q2_metnet._functional_analysis import analyzeFeatures
+from q2_metnet._generateFeatures import generateFeatures
+from .synthetic import availableReconstruction, syntheticFrequency, syntheticTaxonomy, temporaryFolder
+
+class GenerateFeaturesSize:
+
+    ##########################################################################
+    # generateFeatures over cohorts of increasing size and density
+    ##########################################################################
+
+    params = ([1000, 10000, 100000], [10, 1000, 10000], [0.001, 0.01])
+    param_names = ["n_asvs", "n_samples", "density"]
+    timeout = 1800
+
+    def setup(self, n_asvs, n_samples, density):
+        availableReconstruction("SYNTHETIC", temporaryFolder())
+        self.frequency = syntheticFrequency(n_asvs, n_samples, density)
+        self.taxa = syntheticTaxonomy("SYNTHETIC", n_asvs)
+        # Compile the reference and load the model outside of the timings
+        generateFeatures(syntheticFrequency(n_asvs, 2, 0.5), self.taxa, selection = "SYNTHETIC")
+
+    def time_generateFeatures(self, n_asvs, n_samples, density):
+        generateFeatures(self.frequency, self.taxa, selection = "SYNTHETIC", chunk_size = 1000)
+
+    def peakmem_generateFeatures(self, n_asvs, n_samples, density):
+        generateFeatures(self.frequency, self.taxa, selection = "SYNTHETIC", chunk_size = 1000)
+
+class GenerateFeaturesLevel:
+
+    ##########################################################################
+    # generateFeatures for each taxonomic level and reconstruction. The
+    # bundled reconstructions are skipped when their reaction-by-taxon
+    # matrices have not been fetched from LFS
+    ##########################################################################
+
+    params = (["SYNTHETIC", "AGREDA", "AGORAv103", "AGORAv201"], ["k", "p", "c", "o", "f", "g", "s"])
+    param_names = ["selection", "level"]
+    timeout = 1800
+
+    def setup(self, selection, level):
+        availableReconstruction(selection, temporaryFolder())
+        self.frequency = syntheticFrequency(10000, 100, 0.01)
+        self.taxa = syntheticTaxonomy(selection, 10000)
+        generateFeatures(syntheticFrequency(10000, 2, 0.5), self.taxa, selection = selection, level = level)
+
+    def time_generateFeatures(self, selection, level):
+        generateFeatures(self.frequency, self.taxa, selection = selection, level = level)
+
+    def peakmem_generateFeatures(self, selection, level):
+        generateFeatures(self.frequency, self.taxa, selection = selection, level = level)
+
+class AnalyzeFeatures:
+
+    ##########################################################################
+    # analyzeFeatures (scores and the three differential analyses) over
+    # cohorts of increasing size
+    ##########################################################################
+
+    params = ([100, 1000], ["single", "all_pairwise"])
+    param_names = ["n_samples", "contrasts"]
+    timeout = 1800
+
+    def setup(self, n_samples, contrasts):
+        availableReconstruction("SYNTHETIC", temporaryFolder())
+        self.frequency = syntheticFrequency(10000, n_samples, 0.01)
+        self.taxa = syntheticTaxonomy("SYNTHETIC", 10000)
+        groups = pd.Series(["group%d" % (x % 4) for x in range(n_samples)],
+                           index = pd.Index(self.frequency.ids(), name = "sample-id"), name = "group")
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+        generateFeatures(syntheticFrequency(10000, 2, 0.5), self.taxa, selection = "SYNTHETIC")
+
+    def time_analyzeFeatures(self, n_samples, contrasts):
+        analyzeFeatures(self.frequency, self.taxa, self.metadata, "group0", "group1", selection = "SYNTHETIC",
+                        contrasts = contrasts)
+
+    def peakmem_analyzeFeatures(self, n_samples, contrasts):
+        analyzeFeatures(self.frequency, self.taxa, self.metadata, "group0", "group1", selection = "SYNTHETIC",
+                        contrasts = contrasts)
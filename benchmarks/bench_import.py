@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from q2_metnet.tests.test_import import BASELINE, _heavyModules
+
+class ImportPlugin:
+
+    ##########################################################################
+    # Time of the plugin discovery (qiime --help, qiime info, ...) and heavy
+    # modules loaded by it on top of QIIME 2
+    ##########################################################################
+
+    timeout = 300
+
+    def timeraw_plugin_setup(self):
+        return "import q2_metnet.plugin_setup", BASELINE
+
+    def track_heavy_modules(self):
+        return len(_heavyModules())
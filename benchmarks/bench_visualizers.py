@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import qiime2
+from q2_metnet._boxplot import plotBoxplot
+from q2_metnet._clustermap import plotClusteMap
+from q2_metnet._pca import plotPCA
+from q2_metnet._statistics import _differentialTest, _sortResults
+from .synthetic import syntheticScores
+
+class Visualizers:
+
+    ##########################################################################
+    # Visualizers over tables of features x samples of increasing size
+    ##########################################################################
+
+    params = ([100, 1000, 5000], [20, 200])
+    param_names = ["n_features", "n_samples"]
+    timeout = 1800
+
+    def setup(self, n_features, n_samples):
+        table, groups = syntheticScores(["feature%d" % x for x in range(n_features)], n_samples)
+        # Visualizers receive the scores as a features x samples dataframe
+        self.table = table.to_dataframe(dense = True).transpose()
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+        self.results = _sortResults(_differentialTest(self.table, groups.index[groups == "group0"],
+                                                      groups.index[groups == "group1"]))
+        self.output_dir = tempfile.mkdtemp(prefix = "q2-metnet-benchmarks-")
+
+    def teardown(self, n_features, n_samples):
+        plt.close("all")
+        shutil.rmtree(self.output_dir, ignore_errors = True)
+
+    def time_plotPCA(self, n_features, n_samples):
+        plotPCA(self.output_dir, self.table, sample_metadata = self.metadata)
+
+    def peakmem_plotPCA(self, n_features, n_samples):
+        plotPCA(self.output_dir, self.table, sample_metadata = self.metadata)
+
+    def time_plotClusteMap(self, n_features, n_samples):
+        plotClusteMap(self.output_dir, self.table, sample_metadata = self.metadata)
+
+    def peakmem_plotClusteMap(self, n_features, n_samples):
+        plotClusteMap(self.output_dir, self.table, sample_metadata = self.metadata)
+
+    def time_plotBoxplot(self, n_features, n_samples):
+        plotBoxplot(self.output_dir, self.table, self.results, self.metadata, self.results.index[0],
+                    "group0", "group1")
+
+class LargeClustermap:
+
+    ##########################################################################
+    # Clustermap of the most variable features of tables of the size of the
+    # reaction scores of AGORA2
+    ##########################################################################
+
+    params = ([20000, 60000], [500, 2000])
+    param_names = ["n_features", "max_features"]
+    timeout = 1800
+
+    def setup(self, n_features, max_features):
+        table, groups = syntheticScores(["feature%d" % x for x in range(n_features)], 200)
+        self.table = table.to_dataframe(dense = True).transpose()
+        self.metadata = qiime2.CategoricalMetadataColumn(groups)
+        self.output_dir = tempfile.mkdtemp(prefix = "q2-metnet-benchmarks-")
+
+    def teardown(self, n_features, max_features):
+        plt.close("all")
+        shutil.rmtree(self.output_dir, ignore_errors = True)
+
+    def time_plotClusteMap(self, n_features, max_features):
+        plotClusteMap(self.output_dir, self.table, sample_metadata = self.metadata, max_features = max_features)
+
+    def peakmem_plotClusteMap(self, n_features, max_features):
+        plotClusteMap(self.output_dir, self.table, sample_metadata = self.metadata, max_features = max_features)
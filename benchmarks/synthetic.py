@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import biom
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from q2_metnet._reference import _RECONSTRUCTIONS, _referenceFile
+
+# Taxonomic levels of the species of a reconstruction, from kingdom to genus
+_LEVELS = ["KINGDOM", "PHYLUM", "CLASS", "ORDER", "FAMILY", "GENUS"]
+_PREFIXES = ["k__", "p__", "c__", "o__", "f__", "g__", "s__"]
+
+def syntheticReconstruction(folder, n_reactions = 2000, n_strains = 300, n_exchanges = 200,
+                            n_subsystems = 60, density = 0.2, seed = 0):
+
+    ##########################################################################
+    # Write a small metabolic reconstruction with the same files as the
+    # bundled ones and register it as the SYNTHETIC selection, so that the
+    # benchmarks run without the reaction-by-taxon matrices stored in LFS
+    ##########################################################################
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok = True)
+    files = {x: os.path.join(folder, "SYNTHETIC_%s" % x) for x in ["rxnInfo.csv", "metInfo.csv", "taxonomy.csv",
+                                                                   "spInfo.tsv", "rxnTaxMat.csv",
+                                                                   "Exchange_metabolites.tsv", "Input_reactions.tsv"]}
+
+    # Strains grouped in genera, families, ... as a balanced tree
+    genus = rng.integers(0, max(n_strains // 4, 1), size = n_strains)
+    species = pd.DataFrame({"NCBI.ID": np.arange(n_strains),
+                            "KINGDOM": "Bacteria",
+                            "PHYLUM": ["Phylum%d" % (x // 64) for x in genus],
+                            "CLASS": ["Class%d" % (x // 32) for x in genus],
+                            "ORDER": ["Order%d" % (x // 16) for x in genus],
+                            "FAMILY": ["Family%d" % (x // 4) for x in genus],
+                            "GENUS": ["Genus%d" % x for x in genus]})
+    species["NCBI.NAMES"] = ["Genus%d species%d" % (x, y % 3) for x, y in zip(genus, range(n_strains))]
+    species["AGORA.NAMES"] = ["%s strain%d" % (x, y) for x, y in zip(species["NCBI.NAMES"], range(n_strains))]
+    species["MODEL.NAMES"] = [x.replace(" ", "_") for x in species["AGORA.NAMES"]]
+    # Same layout as the bundled files: 1-based row labels without a header
+    species.index = range(1, n_strains + 1)
+    species.to_csv(files["spInfo.tsv"], sep = "\t", index_label = False)
+    pd.DataFrame({"taxonomy": species["MODEL.NAMES"].values}).to_csv(files["taxonomy.csv"], index = False)
+
+    # Reactions present in a random subset of the strains
+    presence = sparse.random(n_reactions, n_strains, density = density, random_state = seed, format = "csr")
+    presence.data[:] = 1
+    rxnTax = pd.DataFrame(presence.toarray().astype(np.uint8), columns = species["MODEL.NAMES"].values)
+    rxnTax.to_csv(files["rxnTaxMat.csv"], index = False)
+
+    mets = ["met%d[e]" % x for x in range(n_exchanges)] + ["met%d[c]" % x for x in range(n_exchanges, 2 * n_exchanges)]
+    pd.DataFrame({"mets": mets,
+                  "metNames": ["Metabolite %d" % x for x in range(len(mets))],
+                  "metID": ["cpd%05d" % x for x in range(len(mets))],
+                  "metFormulas": "C6H12O6", "metCharges": 0, "metKEGGID": "", "metHMDBID": "",
+                  "b": 0, "csense": "E"}).to_csv(files["metInfo.csv"], index = False)
+
+    rxnID = np.array(["rxnSYN%d" % x for x in range(n_reactions)])
+    subsystems = ["Exchange/demand reaction"] * n_exchanges + \
+                 ["Subsystem%d" % x if x % 10 else "Subsystem%d;Subsystem%d" % (x, x + 1)
+                  for x in rng.integers(0, n_subsystems, size = n_reactions - n_exchanges)]
+    taxonomy = [";".join(str(y + 1) for y in presence.indices[presence.indptr[x]:presence.indptr[x+1]]) or "1"
+                for x in range(n_reactions)]
+    pd.DataFrame({"rxnID": rxnID, "rxns": ["R%d" % x for x in range(n_reactions)],
+                  "rxnNames": ["Reaction %d" % x for x in range(n_reactions)],
+                  "subSystems": subsystems, "lb": -1000, "ub": 1000, "c": 0,
+                  "eqMet": [mets[x] if x < n_exchanges else "" for x in range(n_reactions)],
+                  "eqS": -1, "taxonomy": taxonomy}).to_csv(files["rxnInfo.csv"], index = False)
+
+    pd.DataFrame({"rxnID": rxnID[:n_exchanges],
+                  "metNames": ["Metabolite %d" % x for x in range(n_exchanges)],
+                  "Class": ["Class %d" % (x % 12) for x in range(n_exchanges)]}).to_csv(files["Exchange_metabolites.tsv"],
+                                                                                    sep = "\t", index = False)
+    pd.DataFrame({"inputs": rxnID[:n_exchanges:2]}).to_csv(files["Input_reactions.tsv"], sep = "\t", index = False)
+
+    _RECONSTRUCTIONS["SYNTHETIC"] = {"reactions": files["rxnInfo.csv"],
+                                     "metabolites": files["metInfo.csv"],
+                                     "taxonomy": files["taxonomy.csv"],
+                                     "species": files["spInfo.tsv"],
+                                     "rxnTax": files["rxnTaxMat.csv"],
+                                     "exchanges": files["Exchange_metabolites.tsv"],
+                                     "inputs": files["Input_reactions.tsv"]}
+    return _RECONSTRUCTIONS["SYNTHETIC"]
+
+def availableReconstruction(selection, folder):
+
+    ##########################################################################
+    # Prepare the selected reconstruction, raising NotImplementedError (asv
+    # skips the benchmark) if its reaction-by-taxon matrix is not available
+    ##########################################################################
+
+    if selection == "SYNTHETIC":
+        if "SYNTHETIC" not in _RECONSTRUCTIONS:
+            syntheticReconstruction(folder)
+        return
+
+    filename = _referenceFile(selection, "rxnTax")
+    if not os.path.exists(filename):
+        raise NotImplementedError("%s is not available" % filename)
+    with open(filename, "rb") as fh:
+        if fh.read(40).startswith(b"version https://git-lfs"):
+            raise NotImplementedError("%s is a Git LFS pointer" % filename)
+
+def syntheticTaxonomy(selection, n_asvs, unmatched = 0.2, seed = 0):
+
+    ##########################################################################
+    # FeatureData[Taxonomy] of ASVs drawn from the species of a
+    # reconstruction, with a fraction of them assigned to unknown genera
+    ##########################################################################
+
+    rng = np.random.default_rng(seed)
+    species = pd.read_csv(_referenceFile(selection, "species"), sep = "\t")
+
+    strains = species.iloc[rng.integers(0, len(species.index), size = n_asvs),]
+    levels = [strains[x].astype(str).values for x in _LEVELS]
+    levels.append(np.array([str(x).split(" ")[1] if len(str(x).split(" ")) > 1 else ""
+                            for x in strains["NCBI.NAMES"].values]))
+    unknown = rng.random(n_asvs) < unmatched
+    levels[-2] = np.where(unknown, "Unknown", levels[-2])
+
+    taxon = ["; ".join(p + x for p, x in zip(_PREFIXES, each)) for each in zip(*levels)]
+    return pd.DataFrame({"Taxon": taxon}, index = pd.Index(["ASV%d" % x for x in range(n_asvs)], name = "Feature ID"))
+
+def syntheticFrequency(n_asvs, n_samples, density, seed = 0):
+
+    ##########################################################################
+    # FeatureTable[Frequency] of random counts with the given density
+    ##########################################################################
+
+    counts = sparse.random(n_asvs, n_samples, density = density, random_state = seed, format = "csr",
+                           data_rvs = lambda x: np.random.default_rng(seed).integers(1, 1000, size = x))
+    return biom.Table(counts, observation_ids = ["ASV%d" % x for x in range(n_asvs)],
+                      sample_ids = ["sample%d" % x for x in range(n_samples)])
+
+def syntheticScores(feature_ids, n_samples, n_groups = 2, seed = 0):
+
+    ##########################################################################
+    # Table of scores laid out as the outputs of generateFeatures (the
+    # samples are the observations) and the group of each sample
+    ##########################################################################
+
+    rng = np.random.default_rng(seed)
+    samples = ["sample%d" % x for x in range(n_samples)]
+    groups = np.array(["group%d" % (x % n_groups) for x in range(n_samples)])
+
+    scores = rng.gamma(2, size = (n_samples, len(feature_ids)))
+    scores[rng.random(scores.shape) < 0.3] = 0
+    # Shift the first tenth of the features in the first group
+    scores[np.ix_(groups == "group0", np.arange(len(feature_ids) // 10))] += 1
+
+    table = biom.Table(scores, observation_ids = samples, sample_ids = list(feature_ids))
+    return table, pd.Series(groups, index = pd.Index(samples, name = "sample-id"), name = "group")
+
+def temporaryFolder():
+
+    ##########################################################################
+    # Folder of the synthetic files and of the cache of the compiled
+    # reference of a benchmark process
+    ##########################################################################
+
+    folder = tempfile.mkdtemp(prefix = "q2-metnet-benchmarks-")
+    os.environ["Q2_METNET_CACHE_DIR"] = os.path.join(folder, "cache")
+    return folder
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import tempfile
+import h5py
+import numpy as np
+import q2_metnet
+
+# Minimum number of scores of the groups of features read back to build the
+# matrix of the features, so that small chunks of samples do not multiply
+# the reads of the temporary file
+_MIN_GROUP_NNZ = 2**20
+
+# Size of the HDF5 chunks of the matrices, in entries
+_H5_CHUNK = 2**16
+
+_VLEN_STR = h5py.special_dtype(vlen = bytes)
+
+class FeatureTableWriter:
+
+    ##########################################################################
+    # Write a FeatureTable in the BIOM 2.1 format (HDF5) one block of samples
+    # at a time, so that the whole table is never held in memory. The
+    # samples are the observations of the table, as in the outputs of
+    # generateFeatures: the rows of each block are appended to the CSR
+    # matrix of the observations, and its columns are kept in a temporary
+    # file until finish builds the CSC matrix of the features from them, a
+    # group of features at a time
+    ##########################################################################
+
+    def __init__(self, filename, feature_ids):
+        self.filename = filename
+        self.feature_ids = [str(x) for x in feature_ids]
+        self.sample_ids = []
+        self.column_counts = np.zeros(len(self.feature_ids), dtype = np.int64)
+        self.nnz = 0
+        self.max_block_nnz = 0
+        self.n_blocks = 0
+
+        self.h5 = h5py.File(filename, "w")
+        for name, dtype in (("data", np.float64), ("indices", np.int32), ("indptr", np.int32)):
+            self.h5.create_dataset("observation/matrix/%s" % name, shape = (0,), maxshape = (None,), dtype = dtype,
+                                   chunks = (_H5_CHUNK,), compression = "gzip")
+        self.h5["observation/matrix/indptr"].resize((1,))
+        self.h5["observation/matrix/indptr"][0] = 0
+
+        fd, self.scratch_filename = tempfile.mkstemp(suffix = ".h5", dir = os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+        self.scratch = h5py.File(self.scratch_filename, "w")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, block, sample_ids):
+
+        ##########################################################################
+        # Append a dense samples x features block of scores. Missing scores
+        # are stored, as in a table built from a dataframe
+        ##########################################################################
+
+        block = np.asarray(block, dtype = np.float64)
+        rows, cols = np.nonzero(block)
+        values = block[rows, cols]
+        n_rows = len(self.sample_ids)
+
+        # Rows of the block, appended to the matrix of the observations
+        matrix = self.h5["observation/matrix"]
+        for name, array in (("data", values), ("indices", cols)):
+            matrix[name].resize((self.nnz + len(values),))
+            matrix[name][self.nnz:] = array
+        matrix["indptr"].resize((n_rows + block.shape[0] + 1,))
+        matrix["indptr"][n_rows + 1:] = self.nnz + np.cumsum(np.bincount(rows, minlength = block.shape[0]))
+
+        # Columns of the block, ordered by feature and then by sample
+        order = np.argsort(cols, kind = "stable")
+        counts = np.bincount(cols, minlength = len(self.feature_ids))
+        group = self.scratch.create_group(str(self.n_blocks))
+        group.create_dataset("data", data = values[order])
+        group.create_dataset("indices", data = (rows[order] + n_rows).astype(np.int32))
+        group.create_dataset("indptr", data = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+
+        self.column_counts += counts
+        self.nnz += len(values)
+        self.max_block_nnz = max(self.max_block_nnz, len(values))
+        self.n_blocks += 1
+        self.sample_ids.extend(str(x) for x in sample_ids)
+
+    def finish(self):
+
+        ##########################################################################
+        # Write the ids, the attributes and the CSC matrix of the features,
+        # reading back from each block the scores of a group of features at a
+        # time. The groups hold as many scores as the largest block
+        ##########################################################################
+
+        h5 = self.h5
+        h5.attrs["id"] = "No Table ID"
+        h5.attrs["type"] = ""
+        h5.attrs["format-url"] = "http://biom-format.org"
+        h5.attrs["format-version"] = (2, 1)
+        h5.attrs["generated-by"] = "q2-metnet %s" % q2_metnet.__version__
+        h5.attrs["creation-date"] = datetime.datetime.now().isoformat()
+        h5.attrs["shape"] = (len(self.sample_ids), len(self.feature_ids))
+        h5.attrs["nnz"] = self.nnz
+
+        for axis, ids in (("observation", self.sample_ids), ("sample", self.feature_ids)):
+            h5.create_group("%s/metadata" % axis)
+            h5.create_group("%s/group-metadata" % axis)
+            if ids:
+                h5.create_dataset("%s/ids" % axis, shape = (len(ids),), dtype = _VLEN_STR,
+                                  data = [x.encode("utf8") for x in ids], compression = "gzip")
+            else:
+                h5.create_dataset("%s/ids" % axis, shape = (0,), data = [])
+
+        indptr = np.concatenate([[0], np.cumsum(self.column_counts)])
+        matrix = h5.create_group("sample/matrix")
+        matrix.create_dataset("indptr", data = indptr.astype(np.int32), compression = "gzip")
+        # Compressed datasets need chunks, which cannot be empty
+        storage = {"chunks": (min(self.nnz, _H5_CHUNK),), "compression": "gzip"} if self.nnz else {}
+        data = matrix.create_dataset("data", shape = (self.nnz,), dtype = np.float64, **storage)
+        indices = matrix.create_dataset("indices", shape = (self.nnz,), dtype = np.int32, **storage)
+
+        budget = max(self.max_block_nnz, _MIN_GROUP_NNZ)
+        start = 0
+        while start < len(self.feature_ids) and self.nnz:
+            end = int(np.searchsorted(indptr, indptr[start] + budget, side = "right")) - 1
+            end = min(max(end, start + 1), len(self.feature_ids))
+
+            values, rows, features = [], [], []
+            for idx_block in range(self.n_blocks):
+                group = self.scratch[str(idx_block)]
+                bounds = group["indptr"][start:end + 1]
+                values.append(group["data"][bounds[0]:bounds[-1]])
+                rows.append(group["indices"][bounds[0]:bounds[-1]])
+                features.append(np.repeat(np.arange(start, end), np.diff(bounds)))
+
+            # The blocks hold consecutive samples, so a stable sort by feature
+            # leaves the samples of each feature in order
+            order = np.argsort(np.concatenate(features), kind = "stable")
+            data[indptr[start]:indptr[end]] = np.concatenate(values)[order]
+            indices[indptr[start]:indptr[end]] = np.concatenate(rows)[order]
+            start = end
+
+    def close(self):
+        self.h5.close()
+        self.scratch.close()
+        if os.path.exists(self.scratch_filename):
+            os.remove(self.scratch_filename)
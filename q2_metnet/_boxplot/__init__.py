@@ -1,3 +1,3 @@
-from ._boxplot import plotBoxplot
+from ._boxplot import plotBoxplot, plotBoxplots
 
-__all__ = ['plotBoxplot']
\ No newline at end of file
+__all__ = ['plotBoxplot', 'plotBoxplots']
\ No newline at end of file
@@ -1,66 +1,174 @@
 # -*- coding: utf-8 -*-
 
-from pkg_resources import resource_filename
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import os
-import q2templates
 import qiime2
 import re
+from q2_metnet._statistics import _sortResults
 
-TEMPLATES = resource_filename("q2_metnet._boxplot", "assets")
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+
+def _featureName(feature):
+
+    ##########################################################################
+    # Name shown for a feature of the differential results: the metabolite
+    # of the exchange reactions ("rxnID | metabolite"), the ID otherwise
+    ##########################################################################
+
+    if re.findall("\|", feature):
+        return feature.split(" | ")[1]
+    return feature
+
+def _drawBoxplot(task):
+
+    ##########################################################################
+    # Boxplot of the scores of a feature in the control and the condition
+    # samples. It only uses its own figure, so several boxplots can be drawn
+    # at once in different processes
+    ##########################################################################
+
+    from matplotlib.figure import Figure
+
+    filename, control_group, condition_group, control_name, condition_name, title = task
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.boxplot([control_group,condition_group], positions=[0.5,1])
+    ax.set_xticks([0.5,1])
+    ax.set_xticklabels([control_name, condition_name])
+    ax.set_xlim(left = 0.2, right=1.3)
+    ax.set_title(title)
+    ax.set_ylabel(r"Activity Score", weight = "bold", fontsize = 12, labelpad=15)
+    ax.set_xlabel(r"Condition", weight = "bold", fontsize = 12, labelpad=15)
+
+    fig.savefig(filename, dpi=100, bbox_inches='tight')
+    return filename
+
+def _groupColumns(table, sample_metadata, condition_name, control_name):
+
+    ##########################################################################
+    # Positions of the columns of the condition and control samples
+    ##########################################################################
 
-def plotBoxplot(output_dir: str,  table: pd.DataFrame, differentialresults: pd.DataFrame, 
-                sample_metadata: qiime2.CategoricalMetadataColumn, namefeature: str,
-                condition_name: str, control_name: str, title: str = None) -> None:
-    
     # Transform metadata to dataframe
     sample_metadata = sample_metadata.to_dataframe()
-    
+
     # Filter metadata
     sample_metadata = sample_metadata.loc[sample_metadata.index.isin(table.columns)]
-    
-    # Extract groups
-    condition = [sample_metadata.index[x] for x in range(len(sample_metadata)) if sample_metadata.values[x] == condition_name]
-    control = [sample_metadata.index[x] for x in range(len(sample_metadata)) if sample_metadata.values[x] == control_name]
+    labels = sample_metadata.iloc[:,0]
+
+    columns = table.columns.get_indexer(sample_metadata.index)
+    return columns[(labels == condition_name).values], columns[(labels == control_name).values]
+
+def _tableRows(table, features):
+
+    ##########################################################################
+    # Rows of the table of the features of the differential results. The
+    # exchange reactions ("rxnID | metabolite") are found by their rxnID
+    ##########################################################################
+
+    rows = table.index.get_indexer(features)
+    for position in np.flatnonzero(rows < 0):
+        rows[position] = table.index.get_indexer([features[position].split(" | ")[0]])[0]
+
+    if (rows < 0).any():
+        raise AttributeError("The ID for reaction/subsystem or for the samples are not present in the data: %s"
+                             % ", ".join(np.asarray(features)[rows < 0]))
+    return rows
+
+def _contrastResults(differentialresults, condition_name, control_name):
+
+    ##########################################################################
+    # Results of the condition vs control contrast. The results of several
+    # contrasts are labelled "condition vs control | feature": only the rows
+    # of the requested contrast are kept, without that label
+    ##########################################################################
 
-    #if re.findall("S\d+ \| ", namefeature):
-    #    tmp_name = namefeature.split(" | ")[1]
-    #else:
-    #    tmp_name = namefeature.split(" | ")[0]
+    prefix = "%s vs %s | " % (condition_name, control_name)
+    labels = differentialresults.index.astype(str)
+    keep = labels.str.startswith(prefix)
+    if keep.any():
+        results = differentialresults.loc[keep].copy()
+        results.index = labels[keep].str[len(prefix):]
+        return results
+
+    if labels.str.contains(r"^.+ vs .+ \| ", regex = True).all():
+        raise ValueError("The differential results have no rows for the contrast %s vs %s."
+                         % (condition_name, control_name))
+    return differentialresults
+
+def plotBoxplot(output_dir: str,  table: pd.DataFrame, differentialresults: pd.DataFrame,
+                sample_metadata: qiime2.CategoricalMetadataColumn, namefeature: str,
+                condition_name: str, control_name: str, title: str = None) -> None:
+
+    # Plotting libraries are imported when the visualizer runs, so that
+    # registering the plugin stays fast
+    import q2templates
+
+    # Extract groups
+    condition, control = _groupColumns(table, sample_metadata, condition_name, control_name)
 
     try:
-        #control_group = table.loc[tmp_name,control]
-        #condition_group = table.loc[tmp_name,condition]
-        control_group = table.loc[namefeature,control]
-        condition_group = table.loc[namefeature,condition]
-    except:
+        values = table.loc[namefeature].values
+        control_group = values[control]
+        condition_group = values[condition]
+        result = _contrastResults(differentialresults, condition_name, control_name).loc[namefeature]
+    except KeyError:
         raise AttributeError("The ID for reaction/subsystem or for the samples are not present in the data")
-    
-    fig, ax = plt.subplots()
-    plt.boxplot([control_group,condition_group], positions=[0.5,1])
-    plt.xticks([0.5,1], [control_name, condition_name])
-    ax.set_xlim(left = 0.2, right=1.3)
-    
-    temp = differentialresults.index[differentialresults.index == namefeature].values[0]
-    adj_pval = differentialresults.Adjusted_p_Value[differentialresults.index == namefeature].values[0]
-    fold_change = differentialresults.FC[differentialresults.index == namefeature].values[0]
-    
-    if re.findall("\|", temp):
-        name = temp.split(" | ")[1]
-    else:
-        name = temp
-    
+
+    adj_pval = result.Adjusted_p_Value
+    fold_change = result.FC
+
     if title is None:
-        plt.title(name.capitalize() + ' (adj.pval = %f)' % (adj_pval))
-    else:
-        plt.title(title)
-    plt.ylabel(r"Activity Score", weight = "bold", fontsize = 12, labelpad=15)
-    
-    plt.xlabel(r"Condition", weight = "bold", fontsize = 12, labelpad=15)
-    
+        title = _featureName(namefeature).capitalize() + ' (adj.pval = %f)' % (adj_pval)
+
     img_fp = os.path.join(output_dir, 'boxplot.png')
-    plt.savefig(img_fp, dpi=100, bbox_inches='tight')
+    _drawBoxplot((img_fp, control_group, condition_group, control_name, condition_name, title))
 
     index_fp = os.path.join(TEMPLATES, 'index.html')
-    q2templates.render(index_fp, output_dir, context={'p_value': adj_pval, 'fold_change': fold_change})
\ No newline at end of file
+    q2templates.render(index_fp, output_dir, context={'p_value': adj_pval, 'fold_change': fold_change})
+
+def plotBoxplots(output_dir: str,  table: pd.DataFrame, differentialresults: pd.DataFrame,
+                 sample_metadata: qiime2.CategoricalMetadataColumn,
+                 condition_name: str, control_name: str, top_k: int = 50,
+                 fdr: float = 0.05, per_page: int = 10, n_jobs: int = 1) -> None:
+
+    ##########################################################################
+    # Boxplots of the top_k features of the differential results with an
+    # adjusted p-value of at most fdr, in a single paged report
+    ##########################################################################
+
+    import q2templates
+
+    results = _sortResults(_contrastResults(differentialresults, condition_name, control_name))
+    results = results.loc[results.Adjusted_p_Value <= fdr].iloc[:top_k]
+    if results.empty:
+        raise ValueError('No feature has an adjusted p-value of at most %g.' % fdr)
+
+    # Index the table and the groups once for all the features
+    condition, control = _groupColumns(table, sample_metadata, condition_name, control_name)
+    values = table.values[_tableRows(table, results.index.values),:]
+
+    tasks = []
+    for position, feature in enumerate(results.index.values):
+        tasks.append((os.path.join(output_dir, 'boxplot%d.png' % position),
+                      values[position,control], values[position,condition], control_name, condition_name,
+                      _featureName(feature).capitalize() + ' (adj.pval = %f)' % (results.Adjusted_p_Value.iloc[position])))
+
+    if n_jobs == 1:
+        filenames = [_drawBoxplot(x) for x in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            filenames = list(executor.map(_drawBoxplot, tasks))
+
+    results.to_csv(os.path.join(output_dir, 'results.tsv'), sep = '\t', index_label = 'feature-id')
+
+    features = [{'name': feature, 'image': os.path.basename(filename), 'p_value': p_value, 'fold_change': fold_change}
+                for feature, filename, p_value, fold_change in zip(results.index.values, filenames,
+                                                                   results.Adjusted_p_Value.values, results.FC.values)]
+    index_fp = os.path.join(TEMPLATES, 'batch', 'index.html')
+    q2templates.render(index_fp, output_dir, context={'features': features, 'per_page': per_page,
+                                                      'condition_name': condition_name, 'control_name': control_name,
+                                                      'fdr': fdr})
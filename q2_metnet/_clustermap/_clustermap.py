@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from pkg_resources import resource_filename
-import matplotlib.pyplot as plt
+import hashlib
 import pandas as pd
-import seaborn as sns
+import numpy as np
 import os
-import q2templates
 import qiime2
+from q2_metnet._reference import _cacheDir, _writeAtomic, _pruneCache
+from q2_metnet._statistics import _kruskalWallis
 
-TEMPLATES = resource_filename("q2_metnet._clustermap", "assets")
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
 
 clustermap_choices = {
     'metric': {'braycurtis', 'canberra', 'chebyshev', 'cityblock',
@@ -19,6 +19,7 @@ clustermap_choices = {
     'method': {'single', 'complete', 'average', 'weighted', 'centroid',
                'median', 'ward'},
     'cluster': {'samples', 'features', 'both', 'none'},
+    'feature_selection': {'variance', 'significance'},
     'color_scheme': {'Accent', 'Accent_r', 'Blues', 'Blues_r', 'BrBG',
                      'BrBG_r', 'BuGn', 'BuGn_r', 'BuPu', 'BuPu_r', 'CMRmap',
                      'CMRmap_r', 'Dark2', 'Dark2_r', 'GnBu', 'GnBu_r',
@@ -63,12 +64,137 @@ _clustering_map = {'both': {'col_cluster': True, 'row_cluster': True},
                    'features': {'col_cluster': True, 'row_cluster': False},
                    'none': {'col_cluster': False, 'row_cluster': False}}
 
+# Linkage methods only defined over euclidean distances
+_EUCLIDEAN_METHODS = {'centroid', 'median', 'ward'}
+
+# Maximum size in MB of each block of the distance matrix
+_DISTANCE_BLOCK_MB = 64
+
+# Maximum number of samples whose labels are all drawn
+_MAX_LABELS = 200
+
+_LINKAGE_VERSION = 1
+
+# Maximum size of the folder of stored linkages, in MB
+_LINKAGE_CACHE_MB = int(os.environ.get("Q2_METNET_LINKAGE_CACHE_MB", 256))
+
+def _selectFeatures(table, max_features, feature_selection, sample_metadata):
+
+    ##########################################################################
+    # Keep the max_features most variable features of the table, or the ones
+    # that differ the most between the groups of samples (Kruskal-Wallis
+    # test), in their order in the table
+    ##########################################################################
+
+    if max_features == 0 or max_features >= len(table.index):
+        return table
+
+    values = table.values.astype(np.float64)
+    variance = np.nanvar(values, axis = 1)
+    if feature_selection == 'significance':
+        if sample_metadata is None:
+            raise ValueError('The significance feature selection needs the groups of the sample metadata.')
+        p_value = _kruskalWallis(values, sample_metadata.iloc[:,0].values)
+        # The most variable features first among equal p-values
+        order = np.lexsort((-variance, np.nan_to_num(p_value, nan = 2)))
+    else:
+        order = np.argsort(-np.nan_to_num(variance, nan = -1), kind = 'stable')
+
+    return table.iloc[np.sort(order[:max_features]),:]
+
+def _condensedDistances(values, metric):
+
+    ##########################################################################
+    # Condensed distance matrix between the rows of a matrix, as returned by
+    # pdist, computed by blocks of rows so that only one block of the full
+    # matrix is held in memory
+    ##########################################################################
+
+    from scipy.spatial import distance
+
+    n = values.shape[0]
+    # Parameters of the metrics that depend on all the rows, as in pdist
+    kwargs = {}
+    if metric == 'seuclidean':
+        kwargs['V'] = np.var(values, axis = 0, ddof = 1)
+    elif metric == 'mahalanobis':
+        kwargs['VI'] = np.linalg.inv(np.atleast_2d(np.cov(values.T))).T.copy()
+
+    condensed = np.empty(n * (n - 1) // 2)
+    block = max(1, int(_DISTANCE_BLOCK_MB * 2**20) // (8 * max(n, 1)))
+    for start in range(0, n - 1, block):
+        end = min(start + block, n - 1)
+        distances = distance.cdist(values[start:end], values[start:], metric = metric, **kwargs)
+        for row in range(start, end):
+            # Distances of the row to the following ones
+            offset = n * row - row * (row + 1) // 2
+            condensed[offset:offset + n - row - 1] = distances[row - start, row - start + 1:]
+
+    return condensed
+
+def _linkageStore(values, metric, method):
+
+    ##########################################################################
+    # Location of the stored linkage of the rows of a matrix, keyed by its
+    # values and the metric and method of the clustering
+    ##########################################################################
+
+    key = hashlib.sha256()
+    key.update(("%s\n%s\n%s\n" % (metric, method, values.shape)).encode())
+    key.update(np.ascontiguousarray(values).tobytes())
+    return os.path.join(_cacheDir("linkage"), "%s-v%d.npy" % (key.hexdigest()[:32], _LINKAGE_VERSION))
+
+def _linkage(values, metric, method, cache = False):
+
+    ##########################################################################
+    # Hierarchical clustering of the rows of a matrix, with fastcluster when
+    # it is installed. With cache, the linkage is stored and reused for the
+    # same values, metric and method
+    ##########################################################################
+
+    try:
+        from fastcluster import linkage
+    except ImportError:
+        from scipy.cluster.hierarchy import linkage
+
+    if method in _EUCLIDEAN_METHODS and metric != 'euclidean':
+        raise ValueError('The %s method can only be used with the euclidean metric.' % method)
+
+    values = np.asarray(values, dtype = np.float64)
+    store = _linkageStore(values, metric, method) if cache else None
+    if store is not None and os.path.exists(store):
+        try:
+            linkage_matrix = np.load(store, allow_pickle = False)
+            os.utime(store)
+            return linkage_matrix
+        except (OSError, ValueError):
+            pass
+
+    linkage_matrix = linkage(_condensedDistances(values, metric), method = method)
+
+    if store is not None:
+        try:
+            _writeAtomic(store, lambda fh: np.save(fh, linkage_matrix))
+            _pruneCache(os.path.dirname(store), _LINKAGE_CACHE_MB * 2**20)
+        except OSError:
+            pass
+
+    return linkage_matrix
+
 def plotClusteMap(output_dir: str, table: pd.DataFrame,
                 sample_metadata: qiime2.CategoricalMetadataColumn = None,
                 feature_metadata: qiime2.CategoricalMetadataColumn = None, 
                 title: str = None, metric: str = 'euclidean', 
                 method: str = 'average', cluster: str = 'both', 
-                color_scheme: str = 'rocket', xlabels: bool = True, ylabels: bool = True) -> None:
+                color_scheme: str = 'rocket', xlabels: bool = True, ylabels: bool = True,
+                max_features: int = 0, feature_selection: str = 'variance',
+                cache_linkage: bool = False) -> None:
+    
+    # Plotting libraries are imported when the visualizer runs, so that
+    # registering the plugin stays fast
+    import matplotlib.pyplot as plt
+    import q2templates
+    import seaborn as sns
     
     if table.empty:
         raise ValueError('Empty table.')
@@ -87,9 +213,21 @@ def plotClusteMap(output_dir: str, table: pd.DataFrame,
         feature_metadata = feature_metadata.to_dataframe()
         table = table.loc[feature_metadata.index.values,:]
     
-    clustermap = sns.clustermap(table, xticklabels = table.columns,
+    # keep the most variable or significant features of large tables
+    table = _selectFeatures(table, max_features, feature_selection, sample_metadata)
+
+    # cluster the rows and columns over distances computed by blocks
+    clustering = _clustering_map[cluster]
+    linkages = {}
+    if clustering['row_cluster'] and len(table.index) > 1:
+        linkages['row_linkage'] = _linkage(table.values, metric, method, cache_linkage)
+    if clustering['col_cluster'] and len(table.columns) > 1:
+        linkages['col_linkage'] = _linkage(table.values.T, metric, method, cache_linkage)
+
+    xticklabels = table.columns if len(table.columns) <= _MAX_LABELS else 'auto'
+    clustermap = sns.clustermap(table, xticklabels = xticklabels,
                                 method=method, metric = metric,
-                                **_clustering_map[cluster],
+                                **clustering, **linkages,
                                 cmap=color_scheme)
     
     if title is not None:
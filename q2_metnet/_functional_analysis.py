@@ -1,195 +1,211 @@
 # -*- coding: utf-8 -*-
 
-import pkg_resources
-from scipy import stats
-from statsmodels.stats import multitest
+import itertools
+import numpy as np
 import pandas as pd
 import qiime2
 import biom
-from q2_metnet._generateNetwork import _generateModel
+from q2_types.feature_table import BIOMV210Format
+from q2_metnet._generateNetwork import _loadModel
+from q2_metnet._generateFeatures import generateFeatures
+from q2_metnet._instrumentation import _timedAction, _stage
+from q2_metnet._reference import _checkSelection, _referenceFile, _loadTable, _readTable
+from q2_metnet._statistics import _differentialContrasts, _sortResults
+
+contrast_choices = {'single', 'each_vs_control', 'all_pairwise'}
+
+def _scoresTable(table, samples, features = None):
+
+    ##########################################################################
+    # Dataframe of scores (features x samples) of the given samples and
+    # features of a FeatureTable whose observations are the samples. Only
+    # the selected part of its sparse matrix is densified
+    ##########################################################################
+
+    observations = pd.Index(table.ids(axis = 'observation'))
+    rows = observations.get_indexer(samples)
+    if (rows < 0).any():
+        raise KeyError("Samples of the metadata missing from the table: %s" % ", ".join(np.asarray(samples)[rows < 0]))
+
+    matrix = table.matrix_data.tocsr()[rows,:]
+    feature_ids = table.ids(axis = 'sample')
+    if features is not None:
+        columns = pd.Index(feature_ids).get_indexer(features)
+        if (columns < 0).any():
+            raise KeyError("Features missing from the table: %s" % ", ".join(np.asarray(features)[columns < 0]))
+        matrix = matrix.tocsc()[:,columns]
+        feature_ids = np.asarray(features)
+
+    return pd.DataFrame(matrix.toarray().T, index = feature_ids, columns = samples)
+
+def _exchangeIDs(Model, selection_model, input_interest):
+
+    ##########################################################################
+    # Exchange reactions to compare: the ones that can be inputs of the
+    # community, or all of them
+    ##########################################################################
 
-def _extractExchanges(reactions, Model, SampleID, input_interest, stream):
     if input_interest:
-        inputs = pd.read_csv(stream, sep = "\t", encoding = "ISO-8859-1")
-        exchanges = reactions.loc[inputs.inputs,SampleID]
+        inputs = _readTable(_referenceFile(selection_model, "inputs"), "inputs", ["inputs"])
+        return inputs.inputs.values
+    return Model.Exchanges()
+
+def _labelExchanges(results, rxnID, selection_model):
+
+    ##########################################################################
+    # Label the results of each contrast as "rxnID | metabolite"
+    ##########################################################################
+
+    ex_mets = _loadTable(selection_model, "exchanges", ["rxnID", "metNames"])
+    ex_mets = ex_mets.drop_duplicates(subset = 'rxnID', keep = 'first').set_index('rxnID')
+    metnames = ex_mets.loc[rxnID, 'metNames'].values
+    temp = [' | '.join([rxnID[x],metnames[x]]) for x in range(len(rxnID))]
+    for adjusted_results in results.values():
+        adjusted_results.index = temp
+
+    return results
+
+def _contrastGroups(metadata, condition_name, control_name, contrasts):
+
+    ##########################################################################
+    # Samples of each category of the metadata column and list of
+    # (condition, control) pairs of categories to compare
+    ##########################################################################
+
+    df_condition_list = metadata.to_series()
+    levels = sorted(df_condition_list.dropna().unique())
+    groups = {x: df_condition_list.index[[y == x for y in df_condition_list]] for x in levels}
+    
+    if contrasts in ("single", "each_vs_control") and control_name is None:
+        raise ValueError("A control_name is required to compare the conditions against it")
+    if contrasts == "single":
+        if condition_name is None:
+            raise ValueError("A condition_name is required to compare it against the control")
+        pairs = [(condition_name, control_name)]
+    elif contrasts == "each_vs_control":
+        pairs = [(x, control_name) for x in levels if x != control_name]
+    elif contrasts == "all_pairwise":
+        pairs = list(itertools.combinations(levels, 2))
     else:
-        exchanges = reactions.loc[Model.Exchanges(),SampleID]
-        
-    return exchanges
+        raise ValueError("Select a valid contrast among: single, each_vs_control, all_pairwise")
+    
+    # Categories absent from the metadata give empty groups
+    for each in itertools.chain(*pairs):
+        if each not in groups:
+            groups[each] = df_condition_list.index[[False] * len(df_condition_list)]
+    
+    return groups, pairs
 
-def differentialExchanges(reactions: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str, control_name: str,
-                           selection_model: str = "AGREDA", input_interest: str = True) -> pd.DataFrame:
+def _mergeContrasts(results, contrasts):
+
+    ##########################################################################
+    # Sort the results of each contrast and, when several contrasts are
+    # requested, stack them in a long table labelled "condition vs control"
+    ##########################################################################
+
+    if contrasts == "single":
+        return _sortResults(list(results.values())[0])
     
-    df_reactions = reactions.to_dataframe().transpose()
-    df_metadata = metadata.to_dataframe()
-    df_condition_list = metadata.to_series()
+    merged = []
+    for (condition, control), adjusted_results in results.items():
+        adjusted_results = _sortResults(adjusted_results)
+        adjusted_results.index = ['%s vs %s | %s' % (condition, control, x) for x in adjusted_results.index]
+        merged.append(adjusted_results)
     
-    df_reactions = df_reactions.loc[:,df_metadata.index.values]
-    condition_sample = df_metadata.index[[x == condition_name for x in df_condition_list]]
-    control_sample = df_metadata.index[[x == control_name for x in df_condition_list]]
+    return pd.concat(merged)
+
+def differentialExchanges(reactions: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str = None, control_name: str = None,
+                           selection_model: str = "AGREDA", input_interest: str = True, contrasts: str = "single",
+                           permutations: int = 0, bootstrap: int = 0, n_jobs: int = 1, random_seed: int = 0) -> pd.DataFrame:
     
-    if selection_model == "AGREDA":
-        stream_reactions = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-
-        stream = pkg_resources.resource_stream(__name__, 'data/AGREDA/AGREDA_Exchange_metabolites.tsv')
-        ex_mets = pd.read_csv(stream, sep = "\t", encoding = "ISO-8859-1")
-
-        stream = pkg_resources.resource_stream(__name__, 'data/AGREDA/AGREDA_Input_reactions.tsv')
-        exchanges = _extractExchanges(df_reactions, Model, df_metadata.index.values, input_interest, stream)       
-    elif selection_model == "AGORAv103":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_Exchange_metabolites.tsv')
-        ex_mets = pd.read_csv(stream, sep = "\t", encoding = "ISO-8859-1")
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_Input_reactions.tsv')
-        exchanges = _extractExchanges(df_reactions, Model, df_metadata.index.values, input_interest, stream)
-    elif selection_model == "AGORAv201":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv201/AGORA_v2.0.1_Exchange_metabolites.tsv')
-        ex_mets = pd.read_csv(stream, sep = "\t", encoding = "ISO-8859-1")
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv201/AGORA_v2.0.1_Input_reactions.tsv')
-        exchanges = _extractExchanges(df_reactions, Model, df_metadata.index.values, input_interest, stream)
-    else:
-        raise ValueError("Select a valid metabolic reconstruction among: AGREDA, AGORAv103, AGORAv201")
+    df_metadata = metadata.to_dataframe()
     
-    results = pd.DataFrame(index = exchanges.index, columns = ['p-value', 'FC'])
+    groups, pairs = _contrastGroups(metadata, condition_name, control_name, contrasts)
     
-    for idx in exchanges.index:
-        
-        control_group = exchanges.loc[idx,control_sample]
-        condition_group = exchanges.loc[idx,condition_sample]
-        try:
-            p_value = stats.mannwhitneyu(list(control_group.values),list(condition_group.values)).pvalue
-        except ValueError:
-            p_value = 1
-        results.loc[idx,'p-value'] = p_value
-        results.loc[idx,'FC'] = condition_group.mean() - control_group.mean()
+    Model = _loadModel(selection_model)
+
+    exchanges = _scoresTable(reactions, df_metadata.index.values, _exchangeIDs(Model, selection_model, input_interest))
     
-    p_adj = multitest.fdrcorrection(results['p-value'].values)
-    temp = list(Model.rxnID)
-    adjusted_results = pd.DataFrame(data = {'FC': results['FC'].values,
-                                            "p_Value": results['p-value'].values,
-                                            "Adjusted_p_Value": p_adj[1]})
-
-    metnames = [ex_mets.loc[ex_mets.rxnID.isin([x]),'metNames'].values[0] for x in results.index]
-    rxnID = results.index.values
-    temp = [' | '.join([rxnID[x],metnames[x]]) for x in range(len(rxnID))]
-    adjusted_results.index = temp
+    results = _differentialContrasts(exchanges, groups, pairs, permutations, bootstrap, n_jobs, random_seed)
+    results = _labelExchanges(results, exchanges.index.values, selection_model)
 
     # Sort by adjusted p-values and the absolute value of FC
-    adjusted_results['Absolute_FC'] = adjusted_results['FC'].abs()
-    sorted_adjusted_results = adjusted_results.sort_values(by=['Adjusted_p_Value', 'Absolute_FC'], ascending=[True, False])
-    sorted_adjusted_results = sorted_adjusted_results.drop(columns=['Absolute_FC'])
-    
-    return sorted_adjusted_results
+    return _mergeContrasts(results, contrasts)
 
-def differentialSubSystems(subsystems: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str, control_name: str) -> pd.DataFrame:
+def differentialSubSystems(subsystems: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str = None, control_name: str = None,
+                           contrasts: str = "single", permutations: int = 0, bootstrap: int = 0, n_jobs: int = 1,
+                           random_seed: int = 0) -> pd.DataFrame:
 
-    df_subsystem = subsystems.to_dataframe().transpose()
     df_metadata = metadata.to_dataframe()
-    df_condition_list = metadata.to_series()
-    
-    df_subsystem = df_subsystem.loc[:,df_metadata.index.values]
-    condition_sample = df_metadata.index[[x == condition_name for x in df_condition_list]]
-    control_sample = df_metadata.index[[x == control_name for x in df_condition_list]]
-
-    results = pd.DataFrame(index = df_subsystem.index, columns = ['p-value', 'FC'])
-
-    for idx in results.index:
-        control_group = df_subsystem.loc[idx,control_sample]
-        condition_group = df_subsystem.loc[idx,condition_sample]
-        try:
-            p_value = stats.mannwhitneyu(list(control_group.values),list(condition_group.values)).pvalue
-        except ValueError:
-            p_value = 1
-        results.loc[idx,'p-value'] = p_value
-        results.loc[idx,'FC'] = condition_group.mean() - control_group.mean()
     
-    p_adj = multitest.fdrcorrection(results['p-value'].values)
-    adjusted_results = pd.DataFrame(data = {'FC': results['FC'].values,
-                                            "p_Value": results['p-value'].values,
-                                            "Adjusted_p_Value":p_adj[1]})
+    df_subsystem = _scoresTable(subsystems, df_metadata.index.values)
+    groups, pairs = _contrastGroups(metadata, condition_name, control_name, contrasts)
+
+    results = _differentialContrasts(df_subsystem, groups, pairs, permutations, bootstrap, n_jobs, random_seed)
     
     # temp = [' | '.join(['S%d' % x,results.index[x]]) for x in range(len(results.index))]
     # adjusted_results.index = temp
-    adjusted_results.index = results.index
 
     # Sort by adjusted p-values and the absolute value of FC
-    adjusted_results['Absolute_FC'] = adjusted_results['FC'].abs()
-    sorted_adjusted_results = adjusted_results.sort_values(by=['Adjusted_p_Value', 'Absolute_FC'], ascending=[True, False])
-    sorted_adjusted_results = sorted_adjusted_results.drop(columns=['Absolute_FC'])
-    
-    return sorted_adjusted_results
-
-def differentialReactions(reactions: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str, control_name: str,
-                           selection_model: str = "AGREDA") -> pd.DataFrame:
-
-    if selection_model == "AGREDA":
-        stream_reactions = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)        
-    elif selection_model == "AGORAv103":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-    elif selection_model == "AGORAv201":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-    else:
-        raise ValueError("Select a valid metabolic reconstruction among: AGREDA, AGORAv103, AGORAv201")
+    return _mergeContrasts(results, contrasts)
+
+def differentialReactions(reactions: biom.Table, metadata: qiime2.MetadataColumn, condition_name: str = None, control_name: str = None,
+                           selection_model: str = "AGREDA", contrasts: str = "single", permutations: int = 0,
+                           bootstrap: int = 0, n_jobs: int = 1, random_seed: int = 0) -> pd.DataFrame:
+
+    _checkSelection(selection_model)
 
-    df_reactions = reactions.to_dataframe().transpose()
     df_metadata = metadata.to_dataframe()
-    df_condition_list = metadata.to_series()
     
-    df_reactions = df_reactions.loc[:,df_metadata.index.values]
-    condition_sample = df_metadata.index[[x == condition_name for x in df_condition_list]]
-    control_sample = df_metadata.index[[x == control_name for x in df_condition_list]]
+    df_reactions = _scoresTable(reactions, df_metadata.index.values)
+    groups, pairs = _contrastGroups(metadata, condition_name, control_name, contrasts)
 
-    results = pd.DataFrame(index = df_reactions.index, columns = ['p-value', 'FC'])
-    
-    for idx in results.index:
-        
-        control_group = df_reactions.loc[idx,control_sample]
-        condition_group = df_reactions.loc[idx,condition_sample]
-        try:
-            p_value = stats.mannwhitneyu(list(control_group.values),list(condition_group.values)).pvalue
-        except ValueError:
-            p_value = 1
-        results.loc[idx,'p-value'] = p_value
-        results.loc[idx,'FC'] = condition_group.mean() - control_group.mean()
-
-    p_adj = multitest.fdrcorrection(results['p-value'].values)
-    temp = list(Model.rxnID)
-    adjusted_results = pd.DataFrame(data = {'FC': results['FC'].values,
-                                            "p_Value": results['p-value'].values,
-                                            "Adjusted_p_Value": p_adj[1]})
+    results = _differentialContrasts(df_reactions, groups, pairs, permutations, bootstrap, n_jobs, random_seed)
     
     # rxnnames = [Model.rxns[temp.index(x)] for x in results.index]
-    rxnID = results.index.values
     # temp = [' | '.join([rxnID[x],rxnnames[x]]) for x in range(len(rxnID))]
     # adjusted_results.index = temp
-    adjusted_results.index = rxnID
 
     # Sort by adjusted p-values and the absolute value of FC
-    adjusted_results['Absolute_FC'] = adjusted_results['FC'].abs()
-    sorted_adjusted_results = adjusted_results.sort_values(by=['Adjusted_p_Value', 'Absolute_FC'], ascending=[True, False])
-    sorted_adjusted_results = sorted_adjusted_results.drop(columns=['Absolute_FC'])
-    
-    return sorted_adjusted_results
+    return _mergeContrasts(results, contrasts)
+
+def analyzeFeatures(frequency: biom.Table, taxa: pd.DataFrame, metadata: qiime2.MetadataColumn,
+                    condition_name: str = None, control_name: str = None, selection: str = 'AGREDA',
+                    level: str = "s", input_interest: str = True, contrasts: str = "single",
+                    permutations: int = 0, bootstrap: int = 0, chunk_size: int = 0, n_jobs: int = 1,
+                    random_seed: int = 0, strain_weights: str = 'uniform') -> (BIOMV210Format, BIOMV210Format, biom.Table, pd.DataFrame, pd.DataFrame, pd.DataFrame):
+
+    ##########################################################################
+    # generateFeatures followed by the differential analyses of the
+    # reactions, subsystems and exchanges, in a single run. The scores are
+    # read back once from the written tables, the reconstruction is loaded
+    # once and the exchanges are taken from the scores of the reactions
+    ##########################################################################
+
+    with _timedAction("analyzeFeatures"):
+        reactions, subsystems, xmatrix = generateFeatures(frequency, taxa, selection, level, input_interest,
+                                                          chunk_size, n_jobs, strain_weights)
+
+        with _stage("differential analysis") as record:
+            df_metadata = metadata.to_dataframe()
+            groups, pairs = _contrastGroups(metadata, condition_name, control_name, contrasts)
+            Model = _loadModel(selection)
+
+            df_reactions = _scoresTable(biom.load_table(str(reactions)), df_metadata.index.values)
+            reaction_results = _differentialContrasts(df_reactions, groups, pairs, permutations, bootstrap,
+                                                      n_jobs, random_seed)
+
+            df_subsystem = _scoresTable(biom.load_table(str(subsystems)), df_metadata.index.values)
+            subsystem_results = _differentialContrasts(df_subsystem, groups, pairs, permutations, bootstrap,
+                                                       n_jobs, random_seed)
+
+            exchanges = df_reactions.loc[_exchangeIDs(Model, selection, input_interest),:]
+            exchange_results = _differentialContrasts(exchanges, groups, pairs, permutations, bootstrap,
+                                                      n_jobs, random_seed)
+            exchange_results = _labelExchanges(exchange_results, exchanges.index.values, selection)
+            record["rows"] = len(df_reactions.index) + len(df_subsystem.index) + len(exchanges.index)
+
+    return (reactions, subsystems, xmatrix,
+            _mergeContrasts(reaction_results, contrasts),
+            _mergeContrasts(subsystem_results, contrasts),
+            _mergeContrasts(exchange_results, contrasts))
@@ -1,134 +1,344 @@
 # Data types
 import biom
+from q2_types.feature_table import BIOMV210Format
 
 # Functions
+import numpy as np
 import pandas as pd
-import pkg_resources
-from q2_metnet._generateNetwork import _generateModel
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse
+from q2_metnet._biomWriter import FeatureTableWriter
+from q2_metnet._generateNetwork import _loadModel
 from q2_metnet._inputFiles import _extractTaxaPresentAGREDA
+from q2_metnet._instrumentation import _timedAction, _stage, _progress
+from q2_metnet._reference import _referenceFile, _fileDigest, _loadRxnTax, _loadTable, _loadGroupProfiles, \
+    _loadStrainWeights, _GROUP_LEVELS, strain_weight_choices
 
-def _reactionsBetweenSamples(Samples, PresentTaxa, Frequency, Model, rxnTax):
-    
-    count_rxns = pd.DataFrame(index = Model.rxnID, columns = Frequency.ID.values)
-    n_asv = 0
-    for keys, values in PresentTaxa.items():
-        print("Calculating Reaction scores, ASV: %d/%d" % (n_asv,len(PresentTaxa.keys())-1))
-        n_asv += 1
-        tmp =rxnTax.iloc[:,[x-1 for x in values["TAXA"].index.values]]
-        count_rxns.loc[:,keys] = tmp.T.mean().values
-        
-    count_rxns.fillna(0, inplace = True)
-    
-    tmp_freq = Frequency.loc[:,Samples]
-    tmp_freq.index = count_rxns.columns
-    Reactions = count_rxns.dot(tmp_freq)
-        
-    return Reactions
+def _matchedStrains(PresentTaxa, asv_ids):
 
-def _subsystemsBetweenSamples(Reactions, Model, class_exchange):
-    
-    tmp_sub = pd.DataFrame(data = {'Sub': Model.subSystems})
-    tmp_sub.fillna('', inplace = True)
-    tmp_sub = tmp_sub.Sub.drop_duplicates()
-    
-    all_sub = []
-    
-    for x in tmp_sub:
-        if x == "":
-            continue
-        y = x.split(";")
-        all_sub += y
+    ##########################################################################
+    # Labels of the rows of the species table matched to all the ASVs, and
+    # the ASV of each of them
+    ##########################################################################
+
+    strains = [np.asarray(PresentTaxa[asv]["TAXA"].index.values, dtype = np.int64) for asv in asv_ids]
+    n_strains_asv = np.array([len(x) for x in strains], dtype = np.int64)
+    labels = np.concatenate(strains) if len(strains) else np.zeros(0, dtype = np.int64)
+
+    return labels, np.repeat(np.arange(len(asv_ids)), n_strains_asv)
+
+def _strainMembership(PresentTaxa, asv_ids, n_strains, dtype = np.int64, weights = None):
+
+    ##########################################################################
+    # Sparse strains x ASVs matrix with a 1 (or the weight of the strain) for
+    # each strain related to an ASV, together with the number (or the total
+    # weight) of the strains of each ASV
+    ##########################################################################
+
+    labels, cols = _matchedStrains(PresentTaxa, asv_ids)
+    if weights is None:
+        values = np.ones(len(labels), dtype = dtype)
+    else:
+        values = weights.values[weights.index.get_indexer(labels)].astype(dtype)
+    n_strains_asv = np.bincount(cols, weights = values, minlength = len(asv_ids)).astype(dtype)
+
+    # The strain indexes are 1-based positions of the columns of the
+    # reaction-by-taxon matrix, wrapped around as in positional indexing
+    rows = (labels - 1) % n_strains
+    membership = sparse.csc_matrix((values, (rows, cols)), shape = (n_strains, len(asv_ids)))
+
+    return membership, n_strains_asv
+
+def _groupMembership(PresentTaxa, asv_ids, profiles):
+
+    ##########################################################################
+    # Sparse groups x ASVs matrix with a 1 for each group of strains matched
+    # to an ASV, together with the total weight of the strains of each ASV.
+    # Above the species level, a lineage matches every strain of each group
+    # whose name contains it, so the groups cover the same strains
+    ##########################################################################
+
+    labels, codes, sums, totals = profiles
+    strains, cols = _matchedStrains(PresentTaxa, asv_ids)
+    groups = codes[labels.get_indexer(strains)]
+
+    membership = sparse.csc_matrix((np.ones(len(groups), dtype = sums.dtype), (groups, cols)),
+                                   shape = (sums.shape[1], len(asv_ids)))
+    membership.data[:] = 1
+    n_strains_asv = membership.T @ totals
+
+    return membership, n_strains_asv
+
+def _columnBlocks(function, matrix, n_jobs = 1):
+
+    ##########################################################################
+    # Apply a product to n_jobs blocks of columns of a matrix in threads
+    # and stack the results. Every column of a product is computed on its
+    # own, so the result does not depend on the number of blocks. The
+    # threads share the matrices, and scipy and numpy release the GIL while
+    # they multiply them
+    ##########################################################################
+
+    n_blocks = min(n_jobs, matrix.shape[1])
+    if n_blocks <= 1:
+        return function(matrix)
+
+    bounds = np.linspace(0, matrix.shape[1], n_blocks + 1).astype(np.int64)
+    with ThreadPoolExecutor(max_workers = n_blocks) as executor:
+        blocks = list(executor.map(lambda x: function(matrix[:,x[0]:x[1]]), zip(bounds[:-1], bounds[1:])))
+
+    if sparse.issparse(blocks[0]):
+        return sparse.hstack(blocks)
+    return np.hstack(blocks)
+
+def _reactionPresence(PresentTaxa, asv_ids, rxnTax, n_jobs = 1, profiles = None, weights = None):
+
+    ##########################################################################
+    # Mean presence of each reaction across the strains of each ASV, as a
+    # sparse reactions x ASVs matrix, optionally weighting the strains. With
+    # the profiles of the groups of strains of a level, the sums are taken
+    # from the groups instead of the strains. Presences are summed as
+    # integers without weights, so the means are exact
+    ##########################################################################
+
+    if profiles is not None:
+        membership, n_strains_asv = _groupMembership(PresentTaxa, asv_ids, profiles)
+        presence = profiles[2]
+    else:
+        dtype = np.int64 if rxnTax.dtype.kind in "biu" and weights is None else np.float64
+        membership, n_strains_asv = _strainMembership(PresentTaxa, asv_ids, rxnTax.shape[1], dtype, weights)
+        presence = rxnTax.astype(dtype)
+    count_rxns = sparse.csc_matrix(_columnBlocks(lambda x: presence @ x, membership, n_jobs), dtype = np.float64)
+    count_rxns.sort_indices()
+    count_rxns.data /= np.repeat(n_strains_asv, np.diff(count_rxns.indptr))
+
+    return count_rxns
+
+def _reactionsBetweenSamples(Samples, PresentTaxa, Frequency, Abundances, Model, rxnTax, count_rxns = None, n_jobs = 1):
+
+    if count_rxns is None:
+        count_rxns = _reactionPresence(PresentTaxa, Frequency.ID.values, rxnTax, n_jobs)
+
+    # Weight the reaction presences by the relative abundance of the ASVs,
+    # both sparse until the product
+    tmp_freq = sparse.csc_matrix(Abundances, dtype = np.float64)
+    count_rxns = count_rxns.tocsr()
+    Reactions = _columnBlocks(lambda x: (count_rxns @ x).toarray(), tmp_freq, n_jobs)
+
+    # Samples without counts have undefined scores for every reaction
+    Reactions[:,np.isnan(tmp_freq.sum(axis = 0).A.ravel())] = np.nan
+
+    return pd.DataFrame(Reactions, index = Model.rxnID, columns = Samples)
+
+def _subsystemIncidence(Model, class_exchange):
+
+    ##########################################################################
+    # Sparse subsystems x reactions matrix, where each row is normalized by
+    # the number of reactions of the subsystem. Exchange reactions take their
+    # class as subsystem
+    ##########################################################################
+
+    exchange_class = class_exchange.drop_duplicates(subset = 'rxnID', keep = 'first')
+    exchange_class = pd.Series(exchange_class.Class.values, index = exchange_class.rxnID.values)
     
-    all_sub = list(set(all_sub))
-    all_sub += list(class_exchange.Class.values)
-    all_sub = list(set(all_sub))
+    rxnID = pd.Series(Model.rxnID)
+    subsystems = pd.Series(Model.subSystems, dtype = object)
+    is_exchange = rxnID.isin(exchange_class.index).values
+    subsystems[is_exchange] = exchange_class.loc[rxnID[is_exchange].values].values
     
-    sub_rxns = pd.DataFrame(index = all_sub, columns = Reactions.index)
+    # One pair for each subsystem of each reaction
+    pairs = pd.DataFrame({'Sub': subsystems.map(lambda x: x.split(";") if isinstance(x, str) else np.nan),
+                          'Rxn': np.arange(len(rxnID))})
+    pairs = pairs.explode('Sub').dropna().drop_duplicates()
     
-    for x in range(len(Model.rxnID)):
-        print("Reaction: %d/%d" % (x,len(Model.rxnID)-1))
-        try:
-            tmp = class_exchange.loc[class_exchange.rxnID.isin([Model.rxnID[x]]),'Class'].values[0]
-        except IndexError:
-            tmp = Model.subSystems[x]
-        try:
-            tmp = tmp.split(";")
-        except AttributeError:
-            continue
-        for each in tmp:
-            sub_rxns.loc[each,Model.rxnID[x]] = 1
+    all_sub, idx_sub = np.unique(pairs.Sub.values.astype(str), return_inverse = True)
+    n_rxns = np.bincount(idx_sub, minlength = len(all_sub))
+    sub_rxns = sparse.csr_matrix((1 / n_rxns[idx_sub], (idx_sub, pairs.Rxn.values.astype(np.int64))),
+                                 shape = (len(all_sub), len(rxnID)))
     
-    sub_rxns.fillna(0,inplace = True)
+    return all_sub, sub_rxns
+
+# Subsystems x reactions matrices already built for each reconstruction
+_SUBSYSTEM_INCIDENCE = {}
+
+# Incidence of the subsystems of a reconstruction, built once per process
+def _cachedSubsystemIncidence(Model, class_exchange, cache_key = None):
+    if cache_key in _SUBSYSTEM_INCIDENCE:
+        return _SUBSYSTEM_INCIDENCE[cache_key]
+    all_sub, sub_rxns = _subsystemIncidence(Model, class_exchange)
+    if cache_key is not None:
+        _SUBSYSTEM_INCIDENCE[cache_key] = (all_sub, sub_rxns)
+    return all_sub, sub_rxns
+
+# Features of the subsystems table: their position and name
+def _subsystemLabels(all_sub):
+    return [' | '.join(['S%d' % x,all_sub[x]]) for x in range(len(all_sub))]
+
+def _subsystemsBetweenSamples(Reactions, Model, class_exchange, cache_key = None, n_jobs = 1):
     
-    sub_rxns = sub_rxns.div(sub_rxns.sum(axis=1), axis=0)
-    sub_rxns.dropna(inplace = True)    
-    SubSystems_Sample = sub_rxns.dot(Reactions)
+    all_sub, sub_rxns = _cachedSubsystemIncidence(Model, class_exchange, cache_key)
     
-    temp = [' | '.join(['S%d' % x,SubSystems_Sample.index[x]]) for x in range(len(SubSystems_Sample.index))]
-    SubSystems_Sample.index = temp
+    SubSystems_Sample = pd.DataFrame(np.asarray(_columnBlocks(lambda x: sub_rxns @ x, Reactions.values, n_jobs)), columns = Reactions.columns)
+    SubSystems_Sample.index = _subsystemLabels(all_sub)
     
     return SubSystems_Sample
 
 def generateFeatures(frequency: biom.Table, taxa: pd.DataFrame, 
-                     selection: str = 'AGREDA', level: str = "s", input_interest: str = True) -> (pd.DataFrame,pd.DataFrame,pd.DataFrame):
-    if selection == "AGREDA":
-        stream_reactions = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__,'data/AGREDA/AGREDA_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGREDA/AGREDA_spInfo.tsv')
-        
-        PresentTaxa, newFrequency, Samples = _extractTaxaPresentAGREDA(frequency, taxa, stream, level)
+                     selection: str = 'AGREDA', level: str = "s", input_interest: str = True,
+                     chunk_size: int = 0, n_jobs: int = 1, strain_weights: str = 'uniform') -> (BIOMV210Format,BIOMV210Format,biom.Table):
+    if strain_weights not in strain_weight_choices:
+        raise ValueError("Select a valid strain weighting among: %s" % ", ".join(sorted(strain_weight_choices)))
 
-        stream = pkg_resources.resource_stream(__name__, 'data/AGREDA/AGREDA_rxnTaxMat.csv')
-        rxnTax = pd.read_csv(stream, sep = ",")
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGREDA/AGREDA_Exchange_metabolites.tsv')
-        class_exchange = pd.read_csv(stream, sep = "\t")
-    elif selection == "AGORAv103":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
-        
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv103/AGORA_v1.0.3_spInfo.tsv')
-        
-        PresentTaxa, newFrequency, Samples = _extractTaxaPresentAGREDA(frequency, taxa, stream, level)
-
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_rxnTaxMat.csv')
-        rxnTax = pd.read_csv(stream, sep = ",")
-
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv103/AGORA_v1.0.3-M_Exchange_metabolites.tsv')
-        class_exchange = pd.read_csv(stream, sep = "\t")
-    elif selection == "AGORAv201":
-        stream_reactions = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_rxnInfo.csv')
-        stream_metabolites = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_metInfo.csv')
-        stream_taxonomy = pkg_resources.resource_filename(__name__, 'data/AGORAv201/AGORA_v2.0.1_taxonomy.csv')
-        Model = _generateModel(stream_reactions, stream_metabolites, stream_taxonomy)
+    with _timedAction("generateFeatures"):
+        with _stage("load") as record:
+            Model = _loadModel(selection)
+
+            rxnTax = _loadRxnTax(selection)
+
+            # Above the species level the strains are matched by groups,
+            # whose reaction profiles are compiled once per reconstruction
+            profiles, weights = None, None
+            if level in _GROUP_LEVELS:
+                profiles = _loadGroupProfiles(selection, level, strain_weights)
+            elif strain_weights != 'uniform':
+                weights = _loadStrainWeights(selection, strain_weights)
+
+            class_exchange = _loadTable(selection, "exchanges", ["rxnID", "Class"])
+            subsystems_key = (selection, _fileDigest(_referenceFile(selection, "reactions")),
+                              _fileDigest(_referenceFile(selection, "exchanges")))
+            record["rows"] = rxnTax.shape[0]
+
+        # The lineages are collapsed and matched to the reconstruction once
+        # for all the samples, kept as a sparse lineages x samples matrix
+        PresentTaxa, newFrequency, abundances, Samples = _extractTaxaPresentAGREDA(frequency, taxa, _referenceFile(selection, "species"), level)
+        if len(Samples) == 0:
+            raise ValueError("The frequency table has no samples to score.")
         
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv201/AGORA_v2.0.1_spInfo.tsv')
+        with _stage("reaction scoring"):
+            count_rxns = _reactionPresence(PresentTaxa, newFrequency.ID.values, rxnTax, n_jobs,
+                                           profiles, weights)
         
-        PresentTaxa, newFrequency, Samples = _extractTaxaPresentAGREDA(frequency, taxa, stream, level)
+        # The samples are scored independently, so they are processed in
+        # chunks, and the scores of each chunk are written to the outputs
+        # before the next one is scored
+        all_sub, sub_rxns = _cachedSubsystemIncidence(Model, class_exchange, subsystems_key)
+        n_samples = len(Samples)
+        step = chunk_size if 0 < chunk_size < n_samples else max(n_samples, 1)
+        sample_abundances = abundances.tocsc()
+        reactions, subsystems = BIOMV210Format(), BIOMV210Format()
+        with FeatureTableWriter(str(reactions), Model.rxnID) as reaction_writer, \
+             FeatureTableWriter(str(subsystems), _subsystemLabels(all_sub)) as subsystem_writer:
+            for start in range(0, n_samples, step):
+                chunk_samples = Samples[start:start+step]
 
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv201/AGORA_v2.0.1_rxnTaxMat.csv')
-        rxnTax = pd.read_csv(stream, sep = ",")
+                with _stage("reaction scoring") as record:
+                    chunk_reactions = _reactionsBetweenSamples(chunk_samples, PresentTaxa, newFrequency, sample_abundances[:,start:start+step],
+                                                               Model, rxnTax, count_rxns, n_jobs)
+                    record["rows"] = len(chunk_samples)
 
-        stream = pkg_resources.resource_stream(__name__, 'data/AGORAv201/AGORA_v2.0.1_Exchange_metabolites.tsv')
-        class_exchange = pd.read_csv(stream, sep = "\t")
-    else:
-        raise ValueError("Select a valid metabolic reconstruction among: AGREDA, AGORAv103, AGORAv201")
+                with _stage("subsystem scoring") as record:
+                    chunk_subsystems = _subsystemsBetweenSamples(chunk_reactions, Model, class_exchange, subsystems_key, n_jobs)
+                    record["rows"] = len(chunk_samples)
 
-    Reactions = _reactionsBetweenSamples(Samples, PresentTaxa, newFrequency, Model, rxnTax)
-    Subsystems = _subsystemsBetweenSamples(Reactions, Model, class_exchange)
-    
-    Xmatrix = newFrequency.copy()
-    new_index = []
-    for idx in Xmatrix.index:
-        tmp_asv = Xmatrix.ID[idx]
-        tmp_taxa = list(PresentTaxa[tmp_asv]['TAXA'].loc[:,'AGORA.NAMES'].values)
-        new_index.append(';'.join([Xmatrix.ID[idx]] + tmp_taxa))
-    Xmatrix.drop(columns = ['LINEAGE','ID'], inplace = True)
-    Xmatrix.index = new_index
+                with _stage("output assembly"):
+                    reaction_writer.append(chunk_reactions.values.T, chunk_samples)
+                    subsystem_writer.append(chunk_subsystems.values.T, chunk_samples)
+                del chunk_reactions, chunk_subsystems
+                _progress("scored %d/%d samples", start + len(chunk_samples), n_samples)
+            
+            with _stage("output assembly") as record:
+                reaction_writer.finish()
+                subsystem_writer.finish()
+
+                new_index = []
+                for idx in newFrequency.index:
+                    tmp_asv = newFrequency.ID[idx]
+                    tmp_taxa = list(PresentTaxa[tmp_asv]['TAXA'].loc[:,'AGORA.NAMES'].values)
+                    new_index.append(';'.join([newFrequency.ID[idx]] + tmp_taxa))
+                
+                xmatrix = biom.Table(sparse.csr_matrix(abundances.T), observation_ids = Samples,
+                                     sample_ids = [str(x) for x in new_index])
+                record["rows"] = n_samples
     
-    return (Reactions, Subsystems, Xmatrix)
+    return reactions, subsystems, xmatrix
+
+def _appendSamples(previous, new, name):
+
+    ##########################################################################
+    # Stack the samples of two FeatureTables with the same features, the
+    # ones of the previous table first
+    ##########################################################################
+
+    previous_features = previous.ids(axis = 'sample')
+    if not np.array_equal(previous_features, new.ids(axis = 'sample')):
+        raise ValueError("The previous %s table does not have the %s of the selected reconstruction. "
+                         "Use the same selection as in the run that produced it" % (name, name))
+
+    return biom.Table(sparse.vstack([previous.matrix_data, new.matrix_data], format = "csr"),
+                      observation_ids = list(previous.ids(axis = 'observation')) + list(new.ids(axis = 'observation')),
+                      sample_ids = list(previous_features))
+
+def _appendXmatrix(previous, new):
+
+    ##########################################################################
+    # Stack the samples of two Xmatrix tables. Their rows (ID;strains) are
+    # matched by their strains; the ones only found in the new table get the
+    # following IDs and are placed after the previous ones
+    ##########################################################################
+
+    def strains(labels):
+        keys = pd.Series([x.split(";", 1)[1] if ";" in x else "" for x in labels])
+        # Lineages matched to the same strains are paired in order
+        return list(zip(keys, keys.groupby(keys).cumcount()))
+
+    previous_labels = list(previous.ids(axis = 'sample'))
+    positions = {x: idx for idx, x in enumerate(strains(previous_labels))}
+    next_id = max([int(x.split(";")[0].replace("M_ASV", "")) + 1 for x in previous_labels
+                   if x.split(";")[0].replace("M_ASV", "").isdigit()] + [0])
+
+    labels = list(previous_labels)
+    columns = []
+    for label, key in zip(new.ids(axis = 'sample'), strains(new.ids(axis = 'sample'))):
+        if key not in positions:
+            positions[key] = len(labels)
+            labels.append(";".join(["M_ASV%d" % next_id] + ([key[0]] if key[0] else [])))
+            next_id += 1
+        columns.append(positions[key])
+
+    previous_matrix = previous.matrix_data.tocoo()
+    new_matrix = new.matrix_data.tocoo()
+    matrix = sparse.vstack([sparse.csr_matrix((previous_matrix.data, (previous_matrix.row, previous_matrix.col)),
+                                              shape = (previous_matrix.shape[0], len(labels))),
+                            sparse.csr_matrix((new_matrix.data, (new_matrix.row, np.array(columns, dtype = np.int64)[new_matrix.col])),
+                                              shape = (new_matrix.shape[0], len(labels)))], format = "csr")
+
+    return biom.Table(matrix, observation_ids = list(previous.ids(axis = 'observation')) + list(new.ids(axis = 'observation')),
+                      sample_ids = labels)
+
+def appendFeatures(frequency: biom.Table, taxa: pd.DataFrame, reactions: biom.Table, subsystems: biom.Table,
+                   xmatrix: biom.Table, selection: str = 'AGREDA', level: str = "s", input_interest: str = True,
+                   chunk_size: int = 0, n_jobs: int = 1, strain_weights: str = 'uniform') -> (biom.Table,biom.Table,biom.Table):
+
+    ##########################################################################
+    # Score only the new samples of a cohort and append them to the outputs
+    # of a previous run of generateFeatures. The scores of a sample only
+    # depend on its own abundances, so they are the same as in a full run
+    ##########################################################################
+
+    with _timedAction("appendFeatures"):
+        new_reactions, new_subsystems, new_xmatrix = generateFeatures(frequency, taxa, selection, level, input_interest,
+                                                                      chunk_size, n_jobs, strain_weights)
+
+        with _stage("output assembly") as record:
+            new_reactions = biom.load_table(str(new_reactions))
+            new_subsystems = biom.load_table(str(new_subsystems))
+            repeated = set(reactions.ids(axis = 'observation')) & set(new_reactions.ids(axis = 'observation'))
+            if repeated:
+                raise ValueError("Samples already present in the previous outputs: %s" % ", ".join(sorted(repeated)))
+
+            outputs = (_appendSamples(reactions, new_reactions, "reactions"),
+                       _appendSamples(subsystems, new_subsystems, "subsystems"),
+                       _appendXmatrix(xmatrix, new_xmatrix))
+            record["rows"] = outputs[0].shape[0]
+
+    return outputs
@@ -1,22 +1,39 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import hashlib
+import os
 import pickle
 import pandas as pd
 import numpy as np
-import re
+from scipy import sparse
+from q2_metnet._reference import _referenceFile, _fileDigest, _cacheDir, _writeAtomic, _readTable
+
+# Version of the pickled models in the cache folder. Increase it whenever
+# the attributes of SupraModel change
+_MODEL_VERSION = 4
+
+# Columns of the files of the reconstructions used by SupraModel
+_MODEL_COLUMNS = {"reactions": ["rxnID", "rxns", "rxnNames", "subSystems", "lb", "ub", "c", "eqMet", "eqS", "taxonomy"],
+                  "metabolites": ["metID", "mets", "metNames", "metFormulas", "metCharges", "metKEGGID", "metHMDBID", "b"],
+                  "taxonomy": ["taxonomy"]}
 
 # Define the class for the supra-organism model
 class SupraModel:
     
+    __slots__ = ("rxnID", "rxns", "rxnNames", "subSystems", "lb", "ub", "c", "eqMet", "eqS",
+                 "rxnTaxIncidence", "taxonIndex", "metID", "mets", "metNames", "metFormulas", "metCharges",
+                 "metKEGGID", "metHMDBID", "b", "Taxonomy", "exchangeIndex")
+    
     def __init__(self, S, reactions, metabolites, taxonomy):
         # self.S = S
-        self.rxnID = reactions.rxnID.values
-        self.rxns = reactions.rxns.values
-        self.rxnNames = reactions.rxnNames.values
-        self.subSystems = reactions.subSystems.values
-        self.lb = reactions.lb.values
-        self.ub = reactions.ub.values
-        self.c = reactions.c.values
+        self.rxnID = reactions.rxnID.to_numpy()
+        self.rxns = reactions.rxns.to_numpy()
+        self.rxnNames = reactions.rxnNames.to_numpy()
+        self.subSystems = reactions.subSystems.to_numpy()
+        self.lb = reactions.lb.to_numpy()
+        self.ub = reactions.ub.to_numpy()
+        self.c = reactions.c.to_numpy()
         #self.rxnConfidenceScores = reactions.rxnConfidenceScores.values
         #self.rxnECNumbers = reactions.rxnECNumbers.values
         #self.rxnKEGGID = reactions.rxnKEGGID.values
@@ -24,37 +41,69 @@ class SupraModel:
         #self.rxnSource = reactions.rxnSource.values
         #self.comments = reactions.comments.values
         #self.citations = reactions.citations.values
-        self.eqMet = reactions.eqMet.values
-        self.eqS = reactions.eqS.values
-        self.rxnTax = reactions.taxonomy.values.astype(str)
-        self.metID = metabolites.metID.values
-        self.mets = metabolites.mets.values
-        self.metNames = metabolites.metNames.values
-        self.metFormulas = metabolites.metFormulas.values
-        self.metCharges = metabolites.metCharges.values
-        self.metKEGGID = metabolites.metKEGGID.values
-        self.metHMDBID = metabolites.metHMDBID.values
+        self.eqMet = reactions.eqMet.to_numpy()
+        self.eqS = reactions.eqS.to_numpy()
+        self.metID = metabolites.metID.to_numpy()
+        self.mets = metabolites.mets.to_numpy()
+        self.metNames = metabolites.metNames.to_numpy()
+        self.metFormulas = metabolites.metFormulas.to_numpy()
+        self.metCharges = metabolites.metCharges.to_numpy()
+        self.metKEGGID = metabolites.metKEGGID.to_numpy()
+        self.metHMDBID = metabolites.metHMDBID.to_numpy()
         #self.metChEBIID = metabolites.metChEBIID.values
         #self.metPubChemID = metabolites.metPubChemID.values
         #self.metInChIString = metabolites.metInChIString.values
         #self.metSmiles = metabolites.metSmiles.values
         #self.metAliases = metabolites.metAliases.values
         #self.metSource = metabolites.metSource.values
-        self.b = metabolites.b.values
+        self.b = metabolites.b.to_numpy()
         #self.csense = metabolites.csense.values
-        self.Taxonomy = taxonomy.taxonomy.values
+        self.Taxonomy = taxonomy.taxonomy.to_numpy()
+        
+        # Each distinct taxon name gets an id, and the taxa of each reaction
+        # (1-based positions in Taxonomy, joined by ";") are stored as a
+        # sparse reactions x taxon ids matrix with a 1 for each present taxon
+        names, name_ids = np.unique(self.Taxonomy.astype(str), return_inverse = True)
+        self.taxonIndex = {x: idx for idx, x in enumerate(names)}
+        
+        positions = reactions.taxonomy.astype(str).str.split(";").explode()
+        positions = pd.to_numeric(positions, errors = "coerce").dropna()
+        rows = positions.index.values.astype(np.int32)
+        cols = name_ids[(positions.values.astype(np.int64) - 1) % len(self.Taxonomy)].astype(np.int32)
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype = np.int32), (rows, cols)),
+                                      shape = (len(self.rxnID), len(names)))
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        self.rxnTaxIncidence = incidence
+        
+        # Exchange reactions, in the order of the model, and the name of their
+        # metabolite, found through a map of the metabolites (the first one of
+        # each identifier). Exchanges of mucins are left out
+        met_names = {}
+        for met, name in zip(self.mets, self.metNames):
+            met_names.setdefault(met, name)
+        is_exchange = np.array([isinstance(x, str) and x.startswith("Exchange/demand reaction") for x in self.subSystems],
+                               dtype = bool)
+        self.exchangeIndex = {}
+        for idx_rxn in np.flatnonzero(is_exchange):
+            tmp_ex = met_names.get(self.eqMet[idx_rxn])
+            if isinstance(tmp_ex, str) and "mucin" in tmp_ex:
+                continue
+            self.exchangeIndex[self.rxnID[idx_rxn]] = tmp_ex
     
     # Define a module to extract the reactions' index present in a list of specific taxa
     # Extract the whole list of indexes and a dictionary with index of reacions as key and the count
     # of appearances across taxa as value
     def indexPresentReactonsAndCounts(self, taxa: list):
-        idx = []
-        counts = {}
-        for idx_rxn in range(len(self.rxnID)):
-            present_tax = [self.Taxonomy[int(x)-1]  for x in self.rxnTax[idx_rxn].split(";")]
-            if any([x in present_tax for x in taxa]):
-                idx.append(idx_rxn)
-                counts[idx_rxn] = sum([x in present_tax for x in taxa])
+        query = np.zeros(len(self.taxonIndex), dtype = np.int32)
+        for x in taxa:
+            if x in self.taxonIndex:
+                query[self.taxonIndex[x]] += 1
+        
+        # Number of taxa of the list present in each reaction
+        present = self.rxnTaxIncidence @ query
+        idx = np.flatnonzero(present)
+        counts = dict(zip(idx.tolist(), present[idx].tolist()))
         
         return idx, counts
     
@@ -68,34 +117,47 @@ class SupraModel:
         return unique_counts
     
     # Define a module to extract the exchanges can be generated from a list of specific taxa
-    # Extract the whole list of output and a dictionary with name of metabolite as key and the count
-    # of appearances across taxa as value
-    def Exchanges(self):#, taxa:list):
-        # idx_rxn, counts = self.indexPresentReactonsAndCounts(taxa)
-        exchanges = set()
-        # ex_counts = {}
-        # for each_idx in idx_rxn:
-        for each_idx in range(len(self.rxnID)):
-            if pd.isna(self.subSystems[each_idx]):
-                continue
-            if re.findall("^Exchange/demand reaction",self.subSystems[each_idx]):
-                tmp_ex = self.metNames[np.where(self.mets == self.eqMet[each_idx])][0]
-                # ex = self.metID[np.where(self.mets == self.eqMet[each_idx])][0]
-                if re.findall("mucin", tmp_ex):
-                    continue
-                exchanges.add(self.rxnID[each_idx])
-                # if not ex in exchanges:
-                #     exchanges.append(ex)
-                    # ex_counts[out] = counts[each_idx]
-        return exchanges#, ex_counts
+    # Extract the list of exchange reactions, except the ones of mucins, precomputed when
+    # the model is loaded. exchangeIndex maps each of them to the name of its metabolite
+    def Exchanges(self):
+        return list(self.exchangeIndex.keys())
     
 
 # Load the files to crete the model    
 def _generateModel(filename_reactions, filename_metabolites, filename_taxonomy):
     # Load the files
-    reactions = pd.read_csv(filename_reactions, sep = ",", encoding = "ISO-8859-1")
-    metabolites = pd.read_csv(filename_metabolites, sep = ",", encoding = "ISO-8859-1")
-    taxonomy = pd.read_csv(filename_taxonomy, sep = ",", encoding = "ISO-8859-1")
+    reactions = _readTable(filename_reactions, "reactions", _MODEL_COLUMNS["reactions"])
+    metabolites = _readTable(filename_metabolites, "metabolites", _MODEL_COLUMNS["metabolites"])
+    taxonomy = _readTable(filename_taxonomy, "taxonomy", _MODEL_COLUMNS["taxonomy"])
     # Create the model class
     return SupraModel([], reactions, metabolites, taxonomy)
     
+
+# Build the model of a reconstruction once per set of files: reuse the one
+# already loaded in this process or the one pickled in the cache folder
+@functools.lru_cache(maxsize = 4)
+def _cachedModel(filenames, digests):
+    try:
+        store = os.path.join(_cacheDir("models"), "%s-v%d.pickle" % (hashlib.sha256("".join(digests).encode()).hexdigest()[:16],
+                                                                      _MODEL_VERSION))
+    except OSError:
+        # The cache folder cannot be created: build the model without storing it
+        return _generateModel(*filenames)
+
+    try:
+        with open(store, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+        pass
+
+    Model = _generateModel(*filenames)
+    try:
+        _writeAtomic(store, lambda fh: pickle.dump(Model, fh, protocol = pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+    return Model
+
+# Load the model of the selected reconstruction
+def _loadModel(selection):
+    filenames = tuple(_referenceFile(selection, key) for key in ("reactions", "metabolites", "taxonomy"))
+    return _cachedModel(filenames, tuple(_fileDigest(x) for x in filenames))
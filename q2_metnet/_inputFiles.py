@@ -1,7 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import functools
+import hashlib
+import os
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from q2_metnet._instrumentation import _stage
+from q2_metnet._reference import _fileDigest, _readTable, _cacheDir, _writeAtomic, _pruneCache
+
+# Version of the stored matches of lineages to the species of a
+# reconstruction. Increase it whenever the matching changes
+_MATCH_VERSION = 1
+
+# Maximum size of the folder of stored matches, in MB
+_MATCH_CACHE_MB = int(os.environ.get("Q2_METNET_MATCH_CACHE_MB", 256))
 
 # Extract the corresponding models in the database to the taxonomic level of the samples
 # Define the level of interest in the phylogenetic tree
@@ -29,10 +42,145 @@ def _fillTaxa(taxon):
     # Join back the taxonomic levels
     return ';'.join(levels)
 
-def _contextTaxa(frequency, taxa, Reference, level):
+class NameIndex:
+
+    ##########################################################################
+    # Trigram index over the names of a column of the reference. A search
+    # returns the same rows as testing if the query is a substring of every
+    # name, but only verifies the names sharing all the trigrams of the query
+    ##########################################################################
+
+    def __init__(self, names):
+        # Repeated names (e.g. the genus of the strains) are indexed once
+        self.rows = {}
+        for row, name in enumerate(names):
+            if isinstance(name, str):
+                self.rows.setdefault(name, []).append(row)
+        self.names = list(self.rows.keys())
+        self.trigrams = {}
+        for idx_name, name in enumerate(self.names):
+            for pos in range(len(name) - 2):
+                self.trigrams.setdefault(name[pos:pos+3], set()).add(idx_name)
+        self.found = {}
+    
+    # Extract the set of rows whose name contains the query
+    def search(self, query):
+        if query not in self.found:
+            if len(query) < 3:
+                candidates = range(len(self.names))
+            else:
+                postings = [self.trigrams.get(query[pos:pos+3], set()) for pos in range(len(query) - 2)]
+                candidates = set.intersection(*sorted(postings, key = len))
+            rows = set()
+            for idx_name in candidates:
+                if query in self.names[idx_name]:
+                    rows.update(self.rows[self.names[idx_name]])
+            self.found[query] = rows
+        return self.found[query]
+
+def _nameIndex(name_indexes, Reference, column):
+    if column not in name_indexes:
+        name_indexes[column] = NameIndex(Reference[column].values)
+    return name_indexes[column]
+
+def _lineagesAtLevel(taxon, depth):
+
+    ##########################################################################
+    # Clean the taxonomic assignations and cut them at the level of interest.
+    # The features without an assignation at that level get a missing value
+    ##########################################################################
+
+    # Fill all taxonomic levels of FeatureData[Taxonomy]
+    lineage = taxon.map(_fillTaxa)
+    lineage = lineage.str.replace("NA", ""). str.replace("\w__","", regex =True). str.replace("[\[\]]","", regex =True)
+
+    # One column per taxonomic level
+    levels = lineage.str.split(";", expand = True)
+    if levels.shape[1] <= depth:
+        return pd.Series(np.nan, index = taxon.index, dtype = object)
+    levels = levels.iloc[:,:depth+1].apply(lambda x: x.str.strip())
+
+    # Join back the levels, removing the features not assigned at the level of interest
+    lineage = levels[0]
+    for each_level in range(1, depth+1):
+        lineage = lineage + ";" + levels[each_level]
+    lineage[levels[depth].isna() | (levels[depth] == "")] = np.nan
+
+    return lineage
+
+def _collapseFrequency(counts, lineages):
+
+    ##########################################################################
+    # Sum the counts (sparse features x samples) of the features with the
+    # same lineage, keeping the order in which lineages first appear, and
+    # normalize each sample. The sums are the product with a sparse lineages
+    # x features aggregation matrix, so the table is never densified. The
+    # samples without counts get missing abundances
+    ##########################################################################
+
+    assigned = np.flatnonzero(lineages.notna().values)
+    codes, names = pd.factorize(lineages.values[assigned], sort = False)
+    aggregation = sparse.csr_matrix((np.ones(len(assigned)), (codes, assigned)),
+                                    shape = (len(names), counts.shape[0]))
+    collapsed = sparse.csc_matrix(aggregation @ counts.astype(np.float64))
+
+    totals = np.asarray(collapsed.sum(axis = 0)).ravel()
+    collapsed.data /= np.repeat(totals, np.diff(collapsed.indptr))
+
+    empty = np.flatnonzero(totals == 0)
+    if len(empty):
+        collapsed = collapsed + sparse.csc_matrix((np.full(len(names) * len(empty), np.nan),
+                                                   (np.tile(np.arange(len(names)), len(empty)), np.repeat(empty, len(names)))),
+                                                  shape = collapsed.shape)
+
+    lineage_ids = pd.DataFrame({"LINEAGE": names, "ID": ["M_ASV%d" % x for x in range(len(names))]})
+
+    return lineage_ids, collapsed.tocsr()
+
+def _matchStore(lineages, reference_digest, level):
+
+    ##########################################################################
+    # Location of the stored matches of a list of lineages, keyed by the
+    # lineages, the species of the reconstruction and the level
+    ##########################################################################
+
+    key = hashlib.sha256()
+    key.update(("%s\n%s\n" % (reference_digest, level)).encode())
+    key.update("\n".join(lineages).encode())
+    return os.path.join(_cacheDir("matches"), "%s-v%d.npz" % (key.hexdigest()[:32], _MATCH_VERSION))
+
+def _loadMatches(store, n_lineages):
+
+    ##########################################################################
+    # Rows of the reference matched to each lineage, or None if they have
+    # not been stored. A stored match is marked as recently used
+    ##########################################################################
+
+    try:
+        with np.load(store, allow_pickle = False) as stored:
+            rows, offsets = stored["rows"], stored["offsets"]
+        os.utime(store)
+    except (OSError, KeyError, ValueError):
+        return None
+    if len(offsets) != n_lineages + 1:
+        return None
+    return [rows[offsets[x]:offsets[x+1]].tolist() for x in range(n_lineages)]
+
+def _saveMatches(store, matches):
+    offsets = np.concatenate([[0], np.cumsum([len(x) for x in matches])]).astype(np.int64)
+    rows = np.array([x for each in matches for x in each], dtype = np.int64)
+    try:
+        _writeAtomic(store, lambda fh: np.savez(fh, rows = rows, offsets = offsets))
+        _pruneCache(os.path.dirname(store), _MATCH_CACHE_MB * 2**20)
+    except OSError:
+        pass
+
+def _contextTaxa(frequency, taxa, Reference, level, name_indexes = None, reference_digest = None):
 
     ##########################################################################
-    # Filter frequency table, removing duplicates and summing their counts
+    # Filter frequency table, removing duplicates and summing their counts.
+    # Returns the species matched to each lineage, the lineages and their
+    # abundances in each sample (sparse lineages x samples) and the samples
     ##########################################################################
 
     correspondent_level = {"k":"KINGDOM",
@@ -53,123 +201,111 @@ def _contextTaxa(frequency, taxa, Reference, level):
     if level not in depth_level.keys():
         raise ValueError("Select a valid lineage level among: k, p, c, o, f, g, s (kingdom, phylum, class, order, family, genus, species)")
     
-    # Transform feature table to dataframe
-    df_frequency = frequency.to_dataframe()
-    
-    # Extract size of feature table and feature dataframe
-    nR1, nC1 = df_frequency.shape
-    nR2, nC2 = taxa.shape
-    
-    # Transpose feature table if necessary
-    if nR1 != nR2:
-        df_frequency = df_frequency.transpose()
-    
-    # Extract sample IDs
-    samples = df_frequency.columns.values
-    
-    # Fill all taxonomic levels of FeatureData[Taxonomy]
-    taxa['Taxon'] = taxa['Taxon'].apply(_fillTaxa)
-    
-    # Transfrom FeatureData[Taxonomy] from dataframe to dictionary
-    dictionary_otu_taxa = taxa['Taxon'].to_dict()
-
-    df_frequency['LINEAGE'] = [dictionary_otu_taxa[x] for x in df_frequency.index]
-    df_frequency['LINEAGE'] = df_frequency['LINEAGE'].str.replace("NA", ""). str.replace("\w__","", regex =True). str.replace("[\[\]]","", regex =True)
-    
-    to_rem = []
-    for idx in df_frequency.index:
-        tmp = df_frequency['LINEAGE'][idx].split(";")
-        tmp = [x.strip() for x in tmp]
-        if len(tmp) < depth_level[level]:
-            to_rem.append(idx)
-            continue
-        if not "" == tmp[depth_level[level]]:
-            df_frequency.loc[idx, 'LINEAGE'] = ";".join(tmp[:depth_level[level]+1])
-        else:
-            to_rem.append(idx)
-        
-    df_frequency.drop(to_rem, inplace = True)
-    
-    unique_taxa = df_frequency.LINEAGE.drop_duplicates()
-    
-    new_Frequency = pd.DataFrame(index = range(len(unique_taxa)), columns = ["LINEAGE", "ID"] + list(samples))
-    
-    count_asv = 0
-    for each_taxa in unique_taxa:
-        tmp = df_frequency.loc[df_frequency.LINEAGE.isin([each_taxa]),samples]
+    with _stage("lineage collapse") as record:
+        # Sparse matrix of the feature table, transposed (without copying it)
+        # when the features are its samples
+        counts = frequency.matrix_data
+        features, samples = frequency.ids(axis = 'observation'), frequency.ids(axis = 'sample')
+        if counts.shape[0] != taxa.shape[0]:
+            counts = counts.T
+            features, samples = samples, features
         
-        tmp_freq = tmp.sum(axis = 0)
-        tmp_freq['ID'] = "M_ASV%d" % count_asv
-        tmp_freq['LINEAGE'] = each_taxa
+        # Lineage of each feature up to the level of interest
+        lineages = _lineagesAtLevel(taxa['Taxon'].loc[features], depth_level[level])
         
-        new_Frequency.loc[count_asv,:] = tmp_freq
-        
-        count_asv += 1
-    
-    for each_sample in samples:
-        new_Frequency.loc[:,each_sample] = new_Frequency.loc[:,each_sample].div(new_Frequency.loc[:,each_sample].sum())
+        # Sum the counts of the features sharing the same lineage
+        new_Frequency, abundances = _collapseFrequency(counts, lineages)
+        record["rows"] = len(new_Frequency.index)
     
     # ##########################################################################
     # ##########################################################################
     
-    results = {}
-    to_rem = []
-    for idx in new_Frequency.index:
+    with _stage("reference match") as record:
+        # Indexes of the reference columns, built the first time they are needed
+        if name_indexes is None:
+            name_indexes = {}
+    
+        # Matches of the same lineages to the same reconstruction are stored
+        # in the cache folder by a previous run
+        store = None
+        cached = None
+        if reference_digest is not None:
+            try:
+                store = _matchStore(new_Frequency.LINEAGE.values, reference_digest, level)
+            except OSError:
+                # The cache folder cannot be created: match without storing
+                store = None
+            if store is not None:
+                cached = _loadMatches(store, len(new_Frequency.index))
+    
+        results = {}
+        to_rem = []
+        matches = []
+        for position, idx in enumerate(new_Frequency.index):
         
-        # Extract the phyla of interest, continuing if empty or unknown
-        tmp = new_Frequency.LINEAGE[idx].split(";")
-        name_phyla = tmp[depth_level[level]]
+            # Extract the phyla of interest, continuing if empty or unknown
+            tmp = new_Frequency.LINEAGE[idx].split(";")
+            name_phyla = tmp[depth_level[level]]
             
-        # if interested on species level, extract the specific species, 
-        # otherwise extract all the species related to the level of interest
-        if level.lower() == "s":
-            try:
-                genus = tmp[depth_level[level]-1].split("__")[1]
-            except:
-                genus = tmp[depth_level[level]-1]
+            # if interested on species level, extract the specific species, 
+            # otherwise extract all the species related to the level of interest
+            if level.lower() == "s":
+                try:
+                    genus = tmp[depth_level[level]-1].split("__")[1]
+                except:
+                    genus = tmp[depth_level[level]-1]
                 
-            name_phyla = " ".join([genus,name_phyla])
+                name_phyla = " ".join([genus,name_phyla])
             
-            present = []
-            for index in Reference.index:
-                if name_phyla in Reference['AGORA.NAMES'][index] or \
-                                    name_phyla in Reference['NCBI.NAMES'][index]:
-                    present.append(index)
-            if len(present) == 0:
-                to_rem.append(idx)
-                continue
-            results[new_Frequency['ID'][idx]] = {"NAME_LEVEL": level.lower()+"__"+name_phyla,
-                                                    "TAXA": Reference.loc[present,]}
+            if cached is not None:
+                present = cached[position]
+            elif level.lower() == "s":
+                present = sorted(_nameIndex(name_indexes, Reference, 'AGORA.NAMES').search(name_phyla) | \
+                                 _nameIndex(name_indexes, Reference, 'NCBI.NAMES').search(name_phyla))
+            else:
+                present = sorted(_nameIndex(name_indexes, Reference, correspondent_level[level]).search(name_phyla))
+            matches.append(present)
             
-        else:
-            present = []
-            for index in Reference.index:
-                if Reference[correspondent_level[level]][index] is np.nan:
-                    continue
-                if name_phyla in Reference[correspondent_level[level]][index]:
-                    present.append(index)
             if len(present) == 0:
                 to_rem.append(idx)
                 continue
             results[new_Frequency['ID'][idx]] = {"NAME_LEVEL": level.lower()+"__"+name_phyla,
-                                                    "TAXA": Reference.loc[present,]}
+                                                    "TAXA": Reference.iloc[present,]}
             
-    new_Frequency.drop(index = to_rem, inplace = True)
+        if cached is None and store is not None:
+            _saveMatches(store, matches)
+        record["rows"] = len(results)
+
+    keep = np.setdiff1d(np.arange(len(new_Frequency.index)), to_rem)
+    new_Frequency = new_Frequency.iloc[keep,]
     new_Frequency.index = range(len(new_Frequency))
+    abundances = abundances[keep,:]
     if len(new_Frequency.index) == 0:
         raise Warning("No samples have a correspondent species in AGREDA")
 
-    return results, new_Frequency, samples
+    return results, new_Frequency, abundances, samples
     
 
-def _extractTaxaPresentAGREDA(frequency, taxa, stream, level):
+@functools.lru_cache(maxsize = None)
+def _loadReference(filename, digest):
+
+    ##########################################################################
+    # Load the species of a reconstruction once per process, together with
+    # the indexes of its name columns
+    ##########################################################################
+
+    return _readTable(filename, "species"), {}
+
+def _extractTaxaPresentAGREDA(frequency, taxa, filename, level):
     
     ##########################################################################
     # Load database species and extract species model information
     ##########################################################################
     
     # Load the reference for each database
-    reference = pd.read_csv(stream, sep = "\t")
+    with _stage("load"):
+        digest = _fileDigest(filename)
+        reference, name_indexes = _loadReference(filename, digest)
     
     # Extract the samples taxa present in the database
-    return _contextTaxa(frequency, taxa, reference, level)
+    return _contextTaxa(frequency, taxa, reference, level, name_indexes, digest)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak memory is not reported
+    resource = None
+
+logger = logging.getLogger("q2_metnet")
+
+# Minimum number of seconds between two progress messages
+_PROGRESS_INTERVAL = 5
+
+# Timers of the actions running in this process, the innermost one last
+_ACTIVE = []
+
+def _peakRSS():
+
+    ##########################################################################
+    # Peak resident memory of the process in MB, or None if unknown
+    ##########################################################################
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / (1024**2 if sys.platform == "darwin" else 1024)
+
+class StageTimer:
+
+    ##########################################################################
+    # Wall time, peak memory and number of rows of each stage of an action.
+    # A stage run several times (e.g. once per chunk of samples) accumulates
+    # its time and rows
+    ##########################################################################
+
+    def __init__(self, action):
+        self.action = action
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.last_progress = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"rows": None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            elapsed = time.perf_counter() - start
+            summary = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": None, "peak_rss_mb": None})
+            summary["calls"] += 1
+            summary["seconds"] += elapsed
+            if record["rows"] is not None:
+                summary["rows"] = (summary["rows"] or 0) + record["rows"]
+            summary["peak_rss_mb"] = _peakRSS()
+            logger.debug("%s: %s took %.3f s (rows: %s)", self.action, name, elapsed, record["rows"])
+
+    def progress(self, message, *args):
+        now = time.perf_counter()
+        if self.last_progress is None or now - self.last_progress >= _PROGRESS_INTERVAL:
+            self.last_progress = now
+            logger.info("%s: " + message, self.action, *args)
+
+    def report(self):
+        return {"action": self.action,
+                "seconds": time.perf_counter() - self.start,
+                "peak_rss_mb": _peakRSS(),
+                "stages": self.stages}
+
+@contextlib.contextmanager
+def _timedAction(action):
+
+    ##########################################################################
+    # Time the stages of an action. When the Q2_METNET_TIMINGS environment
+    # variable is set, the timings are written as JSON to that file, or to
+    # <action>-timings.json if it is a folder. An action run by another one
+    # (e.g. generateFeatures in analyzeFeatures) adds its stages to the
+    # timings of the outer action as "<action>: <stage>" instead
+    ##########################################################################
+
+    timer = StageTimer(action)
+    _ACTIVE.append(timer)
+    try:
+        yield timer
+    finally:
+        _ACTIVE.remove(timer)
+        report = timer.report()
+        logger.info("%s finished in %.3f s (%s)", action, report["seconds"],
+                    ", ".join("%s: %.3f s" % (x, y["seconds"]) for x, y in timer.stages.items()))
+
+        if _ACTIVE:
+            for name, summary in timer.stages.items():
+                _ACTIVE[-1].stages["%s: %s" % (action, name)] = summary
+
+        filename = os.environ.get("Q2_METNET_TIMINGS")
+        if filename and not _ACTIVE:
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, "%s-timings.json" % action)
+            try:
+                with open(filename, "w") as fh:
+                    json.dump(report, fh, indent = 2)
+            except OSError as error:
+                logger.warning("The timings of %s could not be written: %s", action, error)
+
+def _stage(name):
+
+    ##########################################################################
+    # Time a stage of the running action, if any
+    ##########################################################################
+
+    if _ACTIVE:
+        return _ACTIVE[-1].stage(name)
+    return contextlib.nullcontext({"rows": None})
+
+def _progress(message, *args):
+    if _ACTIVE:
+        _ACTIVE[-1].progress(message, *args)
@@ -1,17 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from pkg_resources import resource_filename
-import matplotlib.pyplot as plt
 import pandas as pd
-from sklearn.decomposition import PCA
-import seaborn as sns
+import numpy as np
 import os
-import q2templates
 import qiime2
 
-TEMPLATES = resource_filename("q2_metnet._pca", "assets")
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
 
 pca_choices = {
+    'svd_solver': {'auto', 'full', 'randomized', 'incremental'},
     'color_scheme': {'Accent', 'Accent_r', 'Blues', 'Blues_r', 'BrBG',
                      'BrBG_r', 'BuGn', 'BuGn_r', 'BuPu', 'BuPu_r', 'CMRmap',
                      'CMRmap_r', 'Dark2', 'Dark2_r', 'GnBu', 'GnBu_r',
@@ -50,17 +47,61 @@ pca_choices = {
                      'winter', 'winter_r', 'cividis', 'cividis_r'}
 }
 
+# Number of samples of each chunk of the incremental PCA by default
+_CHUNK_SIZE = 1000
+
+def _fitPCA(values, n_components, svd_solver, chunk_size, random_seed):
+
+    ##########################################################################
+    # Principal components of the samples of a features x samples matrix.
+    # The incremental solver fits the samples by chunks, so only one chunk
+    # of the transposed matrix is copied at a time. Returns the scores
+    # (samples x components), the loadings (features x components) and the
+    # explained variance ratio of each component
+    ##########################################################################
+
+    from sklearn.decomposition import PCA, IncrementalPCA
+    from sklearn.utils import gen_batches
+
+    n_features, n_samples = values.shape
+    if n_components > min(n_features, n_samples):
+        raise ValueError('n_components (%d) cannot be larger than the number of samples (%d) or features (%d).'
+                         % (n_components, n_samples, n_features))
+
+    if svd_solver == 'incremental':
+        chunk_size = max(chunk_size or _CHUNK_SIZE, n_components)
+        # The last chunk is merged with the previous one if it has less
+        # samples than components
+        chunks = list(gen_batches(n_samples, chunk_size, min_batch_size = n_components))
+        pca = IncrementalPCA(n_components = n_components)
+        for chunk in chunks:
+            pca.partial_fit(values[:,chunk].T)
+        scores = np.vstack([pca.transform(values[:,chunk].T) for chunk in chunks])
+    else:
+        pca = PCA(n_components = n_components, svd_solver = svd_solver,
+                  random_state = random_seed if svd_solver in ('auto', 'randomized') else None)
+        scores = pca.fit_transform(values.T)
+
+    return scores, pca.components_.T, pca.explained_variance_ratio_
+
         
 def plotPCA(output_dir: str, table: pd.DataFrame, 
             sample_metadata: qiime2.CategoricalMetadataColumn = None,
             feature_metadata: qiime2.CategoricalMetadataColumn = None, 
             point_label: bool = False, title : str = None,
-            color_scheme: str = 'rocket') -> None:
+            color_scheme: str = 'rocket', n_components: int = 2,
+            svd_solver: str = 'auto', chunk_size: int = 0,
+            random_seed: int = 0) -> None:
+    
+    # Plotting libraries are imported when the visualizer runs, so that
+    # registering the plugin stays fast
+    import matplotlib.pyplot as plt
+    import q2templates
+    import seaborn as sns
     
     def label_point(x, y, val, ax):
-        a = pd.concat({'x': x, 'y': y, 'val': val}, axis=1)
-        for i, point in a.iterrows():
-            ax.text(point['x']+.05, point['y']+.05, str(point['val']))
+        for point_x, point_y, point_val in zip(x, y, val):
+            ax.text(point_x+.05, point_y+.05, str(point_val))
     
     if table.empty:
         raise ValueError('Empty table.')
@@ -79,14 +120,27 @@ def plotPCA(output_dir: str, table: pd.DataFrame,
         feature_metadata = feature_metadata.to_dataframe()
         table = table.loc[feature_metadata.index.values,:]
 
-    pca = PCA(n_components = 2)
-    pca_fit = pca.fit_transform(table.transpose())
+    pca_fit, loadings, explained_variance = _fitPCA(table.values, n_components, svd_solver,
+                                                   chunk_size, random_seed)
     
     points = pd.DataFrame(data = {'label': table.columns.values})
     
+    labels = [x[0] for x in sample_metadata.values] if sample_metadata is not None else 'samples'
     reduced_data = pd.DataFrame(data = {'0':pca_fit[:,0],
                                         '1':pca_fit[:,1],
-                                        'label':[x[0] for x in sample_metadata.values]})
+                                        'label':labels})
+
+    # export the scores, loadings and explained variance of every component
+    components = ['PC%d' % (x + 1) for x in range(n_components)]
+    scores = pd.DataFrame(pca_fit, index = pd.Index(table.columns, name = 'sample-id'), columns = components)
+    if sample_metadata is not None:
+        scores.insert(0, sample_metadata.columns[0], sample_metadata.iloc[:,0].values)
+    scores.to_csv(os.path.join(output_dir, 'scores.tsv'), sep = '\t')
+    pd.DataFrame(loadings, index = pd.Index(table.index, name = 'feature-id'),
+                 columns = components).to_csv(os.path.join(output_dir, 'loadings.tsv'), sep = '\t')
+    pd.DataFrame({'explained_variance_ratio': explained_variance},
+                 index = pd.Index(components, name = 'component')).to_csv(
+                     os.path.join(output_dir, 'explained_variance.tsv'), sep = '\t')
     
     ax = sns.lmplot(x='0',
                 y='1',
@@ -97,9 +151,9 @@ def plotPCA(output_dir: str, table: pd.DataFrame,
                 hue='label',
                 palette=color_scheme)
     
-    plt.xlabel("PCA 1 ("+str(round(pca.explained_variance_ratio_[0]*100,2))+'%)',
+    plt.xlabel("PCA 1 ("+str(round(explained_variance[0]*100,2))+'%)',
                 weight = "bold", fontsize = 14, labelpad=15)
-    plt.ylabel("PCA 2 ("+str(round(pca.explained_variance_ratio_[1]*100,2))+'%)',
+    plt.ylabel("PCA 2 ("+str(round(explained_variance[1]*100,2))+'%)',
                 weight = "bold", fontsize = 14, labelpad=15)
     
     plt.legend(fontsize = 14, loc = "best", frameon=False)
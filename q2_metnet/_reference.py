@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+try:
+    import pyarrow
+except ImportError:
+    # Without pyarrow the tables are read from the CSV files
+    pyarrow = None
+
+# Files that compose each metabolic reconstruction, relative to the package
+_RECONSTRUCTIONS = {
+    "AGREDA": {"reactions": "data/AGREDA/AGREDA_rxnInfo.csv",
+               "metabolites": "data/AGREDA/AGREDA_metInfo.csv",
+               "taxonomy": "data/AGREDA/AGREDA_taxonomy.csv",
+               "species": "data/AGREDA/AGREDA_spInfo.tsv",
+               "rxnTax": "data/AGREDA/AGREDA_rxnTaxMat.csv",
+               "exchanges": "data/AGREDA/AGREDA_Exchange_metabolites.tsv",
+               "inputs": "data/AGREDA/AGREDA_Input_reactions.tsv"},
+    "AGORAv103": {"reactions": "data/AGORAv103/AGORA_v1.0.3-M_rxnInfo.csv",
+                  "metabolites": "data/AGORAv103/AGORA_v1.0.3-M_metInfo.csv",
+                  "taxonomy": "data/AGORAv103/AGORA_v1.0.3-M_taxonomy.csv",
+                  "species": "data/AGORAv103/AGORA_v1.0.3_spInfo.tsv",
+                  "rxnTax": "data/AGORAv103/AGORA_v1.0.3-M_rxnTaxMat.csv",
+                  "exchanges": "data/AGORAv103/AGORA_v1.0.3-M_Exchange_metabolites.tsv",
+                  "inputs": "data/AGORAv103/AGORA_v1.0.3-M_Input_reactions.tsv"},
+    "AGORAv201": {"reactions": "data/AGORAv201/AGORA_v2.0.1_rxnInfo.csv",
+                  "metabolites": "data/AGORAv201/AGORA_v2.0.1_metInfo.csv",
+                  "taxonomy": "data/AGORAv201/AGORA_v2.0.1_taxonomy.csv",
+                  "species": "data/AGORAv201/AGORA_v2.0.1_spInfo.tsv",
+                  "rxnTax": "data/AGORAv201/AGORA_v2.0.1_rxnTaxMat.csv",
+                  "exchanges": "data/AGORAv201/AGORA_v2.0.1_Exchange_metabolites.tsv",
+                  "inputs": "data/AGORAv201/AGORA_v2.0.1_Input_reactions.tsv"}
+}
+
+# Options to read each table of a reconstruction from its CSV file
+_TABLE_OPTIONS = {"reactions": {"sep": ",", "encoding": "ISO-8859-1"},
+                  "metabolites": {"sep": ",", "encoding": "ISO-8859-1"},
+                  "taxonomy": {"sep": ",", "encoding": "ISO-8859-1"},
+                  "species": {"sep": "\t"},
+                  "exchanges": {"sep": "\t", "encoding": "ISO-8859-1"},
+                  "inputs": {"sep": "\t", "encoding": "ISO-8859-1"}}
+
+# Version of the Parquet stores of the tables. Increase it whenever the way
+# they are written changes
+_TABLE_VERSION = 1
+
+# Version of the binary layout of the compiled reaction-by-taxon matrices.
+# Increase it whenever the content of the store changes.
+_STORE_VERSION = 1
+
+# Number of CSV rows parsed at once while compiling the reaction-by-taxon matrices
+_CHUNK_ROWS = 2000
+
+_DIGESTS = {}
+
+# Columns of the species table that group the strains matched at each
+# taxonomic level above the species
+_GROUP_LEVELS = {"k": "KINGDOM", "p": "PHYLUM", "c": "CLASS", "o": "ORDER", "f": "FAMILY", "g": "GENUS"}
+
+# Weights of the strains of a group in its reaction profile
+strain_weight_choices = {"uniform", "species"}
+
+# Version of the stores of the reaction profiles of the groups of strains
+_PROFILE_VERSION = 1
+
+# Reaction profiles of the groups of strains already loaded in this process
+_PROFILES = {}
+
+def _checkSelection(selection):
+    if selection not in _RECONSTRUCTIONS:
+        raise ValueError("Select a valid metabolic reconstruction among: %s" % ", ".join(_RECONSTRUCTIONS.keys()))
+
+def _referenceFile(selection, key):
+
+    ##########################################################################
+    # Path of one of the files of the selected metabolic reconstruction
+    ##########################################################################
+
+    _checkSelection(selection)
+
+    filename = _RECONSTRUCTIONS[selection][key]
+    if os.path.isabs(filename):
+        return filename
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+
+def _cacheDir(*subfolders):
+
+    ##########################################################################
+    # Folder where the compiled reference files are stored. It can be moved
+    # with the Q2_METNET_CACHE_DIR environment variable
+    ##########################################################################
+
+    root = os.environ.get("Q2_METNET_CACHE_DIR")
+    if root is None:
+        root = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+                            "q2-metnet")
+    folder = os.path.join(root, *subfolders)
+    os.makedirs(folder, exist_ok = True)
+    return folder
+
+def _fileDigest(filename):
+
+    ##########################################################################
+    # sha256 of a file, computed once per process while the file is unchanged
+    ##########################################################################
+
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _DIGESTS:
+        digest = hashlib.sha256()
+        with open(filename, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+        _DIGESTS[key] = digest.hexdigest()
+    return _DIGESTS[key]
+
+def _writeAtomic(filename, write):
+
+    ##########################################################################
+    # Write a cache file through a temporary file that is then moved, so
+    # readers never see it partially written
+    ##########################################################################
+
+    fd, tmp_filename = tempfile.mkstemp(dir = os.path.dirname(filename), suffix = ".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            write(fh)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def _pruneCache(folder, max_bytes):
+
+    ##########################################################################
+    # Remove the least recently used files of a cache folder until it takes
+    # at most max_bytes. Files are marked as used by updating their mtime
+    ##########################################################################
+
+    entries = []
+    for name in os.listdir(folder):
+        filename = os.path.join(folder, name)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime_ns, stat.st_size, filename))
+
+    total = sum(x[1] for x in entries)
+    for mtime, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(filename)
+            total -= size
+        except OSError:
+            pass
+
+def _checkNotLFSPointer(filename):
+    with open(filename, "rb") as fh:
+        if fh.read(40).startswith(b"version https://git-lfs"):
+            raise ValueError("%s is a Git LFS pointer, fetch the file with 'git lfs pull' before using it" % filename)
+
+def _rxnTaxStore(filename):
+
+    ##########################################################################
+    # Location of the compiled store of a reaction-by-taxon matrix, keyed
+    # by the sha256 of the CSV file
+    ##########################################################################
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(_cacheDir("rxnTax"),
+                        "%s-%s-v%d.npz" % (name, _fileDigest(filename)[:16], _STORE_VERSION))
+
+def _parseRxnTax(filename):
+
+    ##########################################################################
+    # Parse the dense CSV into a sparse reactions x taxa matrix
+    ##########################################################################
+
+    _checkNotLFSPointer(filename)
+
+    blocks = []
+    columns = None
+    for chunk in pd.read_csv(filename, sep = ",", chunksize = _CHUNK_ROWS):
+        columns = chunk.columns.values.astype(str)
+        blocks.append(sparse.csr_matrix(chunk.values))
+    matrix = sparse.vstack(blocks, format = "csr")
+
+    # The matrix only stores presences, so keep it as small as possible
+    data = matrix.data
+    if data.size == 0 or (np.all(data == np.round(data)) and data.min() >= 0 and data.max() <= 255):
+        matrix = matrix.astype(np.uint8)
+    matrix.sort_indices()
+
+    return matrix, columns
+
+def _compileRxnTax(filename):
+
+    ##########################################################################
+    # Write the compiled store of a reaction-by-taxon matrix
+    ##########################################################################
+
+    store = _rxnTaxStore(filename)
+    matrix, columns = _parseRxnTax(filename)
+
+    _writeAtomic(store, lambda fh: np.savez(fh, version = np.array(_STORE_VERSION),
+                                            sha256 = np.array(_fileDigest(filename)),
+                                            data = matrix.data, indices = matrix.indices, indptr = matrix.indptr,
+                                            shape = np.array(matrix.shape), columns = columns))
+
+    return store, matrix
+
+def _loadRxnTax(selection):
+
+    ##########################################################################
+    # Load the reactions x taxa matrix of the selected reconstruction as a
+    # sparse CSR matrix, compiling its binary store the first time
+    ##########################################################################
+
+    filename = _referenceFile(selection, "rxnTax")
+
+    try:
+        store = _rxnTaxStore(filename)
+        if not os.path.exists(store):
+            return _compileRxnTax(filename)[1]
+    except OSError:
+        # Read-only cache folder: parse the CSV without storing it
+        return _parseRxnTax(filename)[0]
+
+    with np.load(store, allow_pickle = False) as stored:
+        return sparse.csr_matrix((stored["data"], stored["indices"], stored["indptr"]),
+                                 shape = tuple(stored["shape"]))
+
+def _strainWeights(species, strain_weights):
+
+    ##########################################################################
+    # Weight of each strain (row of the species table) in the mean reaction
+    # presence of the strains matched to a lineage: the same for all of them
+    # (uniform), or the inverse of the number of genomes of its species
+    # (species), so that every species weighs the same
+    ##########################################################################
+
+    if strain_weights == "uniform":
+        return np.ones(len(species.index), dtype = np.int64)
+
+    if "SPECIES" in species.columns:
+        names = species["SPECIES"].astype(str)
+    else:
+        # The species is the first two words of the name of the strain
+        names = species["NCBI.NAMES"].astype(str).str.split(" ").str[:2].str.join(" ")
+    return 1 / names.map(names.value_counts()).values.astype(np.float64)
+
+def _loadStrainWeights(selection, strain_weights):
+
+    ##########################################################################
+    # Weights of the strains of the selected reconstruction, indexed by the
+    # labels of the rows of its species table
+    ##########################################################################
+
+    species = _readTable(_referenceFile(selection, "species"), "species")
+    return pd.Series(_strainWeights(species, strain_weights), index = species.index)
+
+def _profileStore(selection, level, strain_weights):
+
+    ##########################################################################
+    # Location of the reaction profiles of the groups of strains of a level,
+    # keyed by the sha256 of the reaction-by-taxon matrix and of the species
+    ##########################################################################
+
+    rxnTax, species = _referenceFile(selection, "rxnTax"), _referenceFile(selection, "species")
+    name = os.path.splitext(os.path.basename(rxnTax))[0]
+    return os.path.join(_cacheDir("rxnTax"),
+                        "%s-%s-%s-%s-%s-v%d.npz" % (name, _fileDigest(rxnTax)[:16], _fileDigest(species)[:16],
+                                                    _GROUP_LEVELS[level], strain_weights, _PROFILE_VERSION))
+
+def _groupProfiles(selection, level, strain_weights):
+
+    ##########################################################################
+    # Group the strains with the same name at a taxonomic level, as matched
+    # by the lineages, and sum the weighted presences of each reaction in
+    # the strains of each group. Returns the labels of the rows of the
+    # species table, the group of each row (-1 without a name), the sparse
+    # reactions x groups sums and the total weight of each group
+    ##########################################################################
+
+    species = _readTable(_referenceFile(selection, "species"), "species")
+    rxnTax = _loadRxnTax(selection)
+
+    names = species[_GROUP_LEVELS[level]].values
+    named = np.flatnonzero([isinstance(x, str) for x in names])
+    codes = np.full(len(names), -1, dtype = np.int64)
+    codes[named], groups = pd.factorize(names[named], sort = False)
+
+    # The rows of the species table are 1-based positions of the columns of
+    # the reaction-by-taxon matrix, wrapped around as in positional indexing
+    weights = _strainWeights(species, strain_weights)
+    columns = (np.asarray(species.index.values, dtype = np.int64) - 1) % rxnTax.shape[1]
+    strain_groups = sparse.csc_matrix((weights[named], (columns[named], codes[named])),
+                                      shape = (rxnTax.shape[1], len(groups)))
+
+    # Presences are summed as integers with uniform weights, so the means
+    # are exact
+    dtype = weights.dtype if rxnTax.dtype.kind in "biu" else np.float64
+    sums = sparse.csc_matrix(rxnTax.astype(dtype) @ strain_groups.astype(dtype))
+    sums.sort_indices()
+    totals = np.bincount(codes[named], weights = weights[named], minlength = len(groups)).astype(weights.dtype)
+
+    return np.asarray(species.index.values, dtype = np.int64), codes, sums, totals
+
+def _loadGroupProfiles(selection, level, strain_weights):
+
+    ##########################################################################
+    # Reaction profiles of the groups of strains of a level of the selected
+    # reconstruction, compiled the first time and kept once per process
+    ##########################################################################
+
+    try:
+        store = _profileStore(selection, level, strain_weights)
+    except OSError:
+        store = None
+    if store is not None and store in _PROFILES:
+        return _PROFILES[store]
+
+    if store is not None and os.path.exists(store):
+        with np.load(store, allow_pickle = False) as stored:
+            profiles = (stored["labels"], stored["codes"],
+                        sparse.csc_matrix((stored["data"], stored["indices"], stored["indptr"]),
+                                          shape = tuple(stored["shape"])),
+                        stored["totals"])
+    else:
+        profiles = _groupProfiles(selection, level, strain_weights)
+        if store is not None:
+            labels, codes, sums, totals = profiles
+            try:
+                _writeAtomic(store, lambda fh: np.savez(fh, labels = labels, codes = codes, data = sums.data,
+                                                        indices = sums.indices, indptr = sums.indptr,
+                                                        shape = np.array(sums.shape), totals = totals))
+            except OSError:
+                # Read-only cache folder: keep the profiles in memory only
+                pass
+
+    labels, codes, sums, totals = profiles
+    profiles = (pd.Index(labels), codes, sums, totals)
+    if store is not None:
+        _PROFILES[store] = profiles
+    return profiles
+
+def _tableStore(filename):
+
+    ##########################################################################
+    # Location of the Parquet store of a table, keyed by the sha256 of the
+    # CSV file
+    ##########################################################################
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(_cacheDir("tables"),
+                        "%s-%s-v%d.parquet" % (name, _fileDigest(filename)[:16], _TABLE_VERSION))
+
+def _compileTable(filename, key):
+
+    ##########################################################################
+    # Write the Parquet store of a table. Parquet keeps the type of each
+    # column and dictionary-encodes the repeated strings (subsystems, taxa)
+    ##########################################################################
+
+    _checkNotLFSPointer(filename)
+
+    store = _tableStore(filename)
+    table = pd.read_csv(filename, low_memory = False, **_TABLE_OPTIONS[key])
+
+    # Columns mixing numbers and text are stored as text
+    for column in table.columns[table.dtypes == object]:
+        values = table[column]
+        table[column] = values.where(values.isna(), values.astype(str))
+    table.columns = table.columns.astype(str)
+
+    _writeAtomic(store, lambda fh: table.to_parquet(fh, engine = "pyarrow", index = True))
+    return store
+
+def _loadTable(selection, key, columns = None):
+
+    ##########################################################################
+    # Read a table of the selected reconstruction, only with the given
+    # columns. The CSV file is the source of truth: when pyarrow is available
+    # it is compiled to a Parquet store the first time and read from there
+    ##########################################################################
+
+    filename = _referenceFile(selection, key)
+    return _readTable(filename, key, columns)
+
+def _readTable(filename, key, columns = None):
+
+    if pyarrow is not None:
+        try:
+            store = _tableStore(filename)
+            if not os.path.exists(store):
+                store = _compileTable(filename, key)
+        except OSError:
+            # Read-only cache folder: read the CSV file
+            pass
+        else:
+            return pd.read_parquet(store, engine = "pyarrow", columns = columns)
+
+    if columns is None:
+        return pd.read_csv(filename, **_TABLE_OPTIONS[key])
+    return pd.read_csv(filename, usecols = lambda x: x in columns, **_TABLE_OPTIONS[key])[columns]
+
+def compileReference(selections = None):
+
+    ##########################################################################
+    # One-time compilation of the reaction-by-taxon matrices of the
+    # reconstructions (all of them by default), of the reaction profiles of
+    # their groups of strains and, when pyarrow is available, of the Parquet
+    # stores of their tables. Returns the stores of the reaction-by-taxon
+    # matrices
+    ##########################################################################
+
+    if selections is None:
+        selections = list(_RECONSTRUCTIONS.keys())
+    elif isinstance(selections, str):
+        selections = [selections]
+
+    stores = {}
+    for selection in selections:
+        filename = _referenceFile(selection, "rxnTax")
+        store = _rxnTaxStore(filename)
+        if not os.path.exists(store):
+            store = _compileRxnTax(filename)[0]
+        stores[selection] = store
+
+        for level in _GROUP_LEVELS:
+            for strain_weights in strain_weight_choices:
+                if not os.path.exists(_profileStore(selection, level, strain_weights)):
+                    _loadGroupProfiles(selection, level, strain_weights)
+
+        if pyarrow is not None:
+            for key in _TABLE_OPTIONS:
+                if not os.path.exists(_tableStore(_referenceFile(selection, key))):
+                    _compileTable(_referenceFile(selection, key), key)
+
+    return stores
+
+if __name__ == "__main__":
+    import sys
+    for selection, store in compileReference(sys.argv[1:] or None).items():
+        print("%s: %s" % (selection, store))
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# scipy.stats and statsmodels are imported by the functions that use them, so
+# that registering the plugin does not load them
+
+def _tieGroups(sorted_values):
+
+    ##########################################################################
+    # Split each sorted row of a matrix into groups of tied values. Returns
+    # the flat position where each group starts, the row of each group, the
+    # average rank of the values of each group and the tie term
+    # sum(t^3 - t) of every row
+    ##########################################################################
+
+    n_rows, n_cols = sorted_values.shape
+
+    new_group = np.empty((n_rows, n_cols), dtype = bool)
+    new_group[:,0] = True
+    new_group[:,1:] = sorted_values[:,1:] != sorted_values[:,:-1]
+
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.append(starts, n_rows * n_cols))
+    rows = starts // n_cols
+
+    # Ranks are 1-based, so a group starting at position i has an average
+    # rank of i + (size + 1) / 2
+    ranks = starts - rows * n_cols + (sizes + 1) / 2
+    tie_term = np.bincount(rows, weights = sizes.astype(np.float64)**3 - sizes, minlength = n_rows)
+
+    return starts, rows, ranks, tie_term
+
+def _asymptoticPValue(U1, n_control, n_condition, tie_term):
+
+    ##########################################################################
+    # Two-sided p-value of the normal approximation of the U statistic, with
+    # tie and continuity corrections, as in stats.mannwhitneyu
+    ##########################################################################
+
+    from scipy import special
+
+    n = n_control + n_condition
+    U = np.maximum(U1, n_control * n_condition - U1)
+    sigma = np.sqrt(n_control * n_condition / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        z = (U - n_control * n_condition / 2 - 0.5) / sigma
+    return np.clip(2 * special.ndtr(-z), 0, 1)
+
+def _mannWhitneyUSorted(values, order, sorted_values, control_columns, condition_columns):
+
+    ##########################################################################
+    # Two-sided Mann-Whitney U test of every row of a matrix (features x
+    # samples) between two sets of its columns, reusing the sorting of the
+    # whole matrix. Each row gets the p-value a separate call to
+    # stats.mannwhitneyu would return: exact when one of the groups has 8
+    # samples or less and the row has no ties, asymptotic otherwise
+    ##########################################################################
+
+    n_control, n_condition = len(control_columns), len(condition_columns)
+
+    # Undefined test with an empty group
+    if n_control == 0 or n_condition == 0:
+        return np.ones(values.shape[0])
+
+    is_control = np.zeros(values.shape[1], dtype = bool)
+    is_control[control_columns] = True
+    in_test = is_control.copy()
+    in_test[condition_columns] = True
+
+    # The columns of both groups keep their sorted order within each row
+    if not in_test.all():
+        keep = in_test[order]
+        order = order[keep].reshape(values.shape[0], n_control + n_condition)
+        sorted_values = sorted_values[keep].reshape(values.shape[0], n_control + n_condition)
+
+    starts, rows, ranks, tie_term = _tieGroups(sorted_values)
+
+    # U statistic of the control group from the sum of its ranks
+    n_control_group = np.add.reduceat(is_control[order].view(np.uint8).ravel(), starts, dtype = np.int64)
+    U1 = np.bincount(rows, weights = ranks * n_control_group, minlength = len(values)) - n_control * (n_control + 1) / 2
+    p_value = _asymptoticPValue(U1, n_control, n_condition, tie_term)
+
+    if n_control <= 8 or n_condition <= 8:
+        exact = tie_term == 0
+        if exact.any():
+            from scipy import stats
+            p_value[exact] = stats.mannwhitneyu(values[np.ix_(exact, control_columns)],
+                                                values[np.ix_(exact, condition_columns)],
+                                                axis = 1, method = "exact").pvalue
+
+    # Missing scores propagate, as in stats.mannwhitneyu
+    p_value[np.isnan(values[:,in_test]).any(axis = 1)] = np.nan
+
+    return p_value
+
+def _mannWhitneyU(control, condition):
+
+    ##########################################################################
+    # Two-sided Mann-Whitney U test of every row of two matrices at once
+    ##########################################################################
+
+    values = np.concatenate([control, condition], axis = 1)
+    columns = np.arange(values.shape[1])
+
+    return _mannWhitneyUSorted(values, np.argsort(values, axis = 1), np.sort(values, axis = 1),
+                               columns[:control.shape[1]], columns[control.shape[1]:])
+
+def _averageRanks(values):
+
+    ##########################################################################
+    # Rank each row of a matrix, averaging the ranks of tied values
+    ##########################################################################
+
+    order = np.argsort(values, axis = 1)
+    starts, rows, ranks, tie_term = _tieGroups(np.take_along_axis(values, order, axis = 1))
+    sizes = np.diff(np.append(starts, values.size))
+
+    average_ranks = np.empty(values.shape)
+    np.put_along_axis(average_ranks, order, np.repeat(ranks, sizes).reshape(values.shape), axis = 1)
+    return average_ranks
+
+def _kruskalWallis(values, labels):
+
+    ##########################################################################
+    # Kruskal-Wallis H test of every row of a matrix (features x samples)
+    # across the groups of its columns given by labels, with the tie
+    # correction of stats.kruskal. Rows with a single value get a p-value
+    # of 1
+    ##########################################################################
+
+    from scipy import stats
+
+    codes, names = pd.factorize(np.asarray(labels), sort = True)
+    n_rows, n = values.shape
+    if len(names) < 2:
+        return np.ones(n_rows)
+
+    order = np.argsort(values, axis = 1)
+    starts, rows, ranks, tie_term = _tieGroups(np.take_along_axis(values, order, axis = 1))
+    sizes = np.diff(np.append(starts, values.size))
+    average_ranks = np.empty(values.shape)
+    np.put_along_axis(average_ranks, order, np.repeat(ranks, sizes).reshape(values.shape), axis = 1)
+
+    # Sum of the ranks of each group, for every row
+    membership = np.zeros((n, len(names)))
+    membership[np.arange(n), codes] = 1
+    n_group = membership.sum(axis = 0)
+    rank_sums = average_ranks @ membership
+
+    H = 12 / (n * (n + 1)) * (rank_sums**2 / n_group).sum(axis = 1) - 3 * (n + 1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        H = H / (1 - tie_term / (n**3 - n))
+    p_value = stats.chi2.sf(H, len(names) - 1)
+    p_value[~np.isfinite(H)] = 1
+
+    # Missing scores propagate, as in stats.kruskal
+    p_value[np.isnan(values).any(axis = 1)] = np.nan
+
+    return p_value
+
+# Number of permutations or bootstrap samples evaluated by each task. It does
+# not depend on the number of workers, so the results only depend on the seed
+_BATCH_SIZE = 250
+
+# Read-only matrices of the resampling tasks, set once in each worker
+_WORKER = {}
+
+def _initWorker(shared):
+    _WORKER.clear()
+    _WORKER.update(shared)
+
+def _permutationBatch(task):
+
+    ##########################################################################
+    # Count, for every feature, the label permutations whose control rank sum
+    # is at least as far from its expected value as the observed one
+    ##########################################################################
+
+    seed, size = task
+    rng = np.random.default_rng(seed)
+    ranks, n_control = _WORKER["ranks"], _WORKER["n_control"]
+    n_samples = ranks.shape[1]
+
+    # One column per permutation, marking the samples labelled as control
+    permuted = rng.permuted(np.tile(np.arange(n_samples), (size, 1)), axis = 1)[:,:n_control]
+    labels = np.zeros((n_samples, size))
+    labels[permuted.T, np.arange(size)] = 1
+
+    deviation = np.abs(ranks @ labels - _WORKER["expected"])
+    return (deviation >= _WORKER["observed"][:,None]).sum(axis = 1)
+
+def _bootstrapBatch(task):
+
+    ##########################################################################
+    # Difference of means of bootstrap samples drawn within each group
+    ##########################################################################
+
+    seed, size = task
+    rng = np.random.default_rng(seed)
+    condition, control = _WORKER["condition"], _WORKER["control"]
+
+    weights_condition = rng.multinomial(condition.shape[1], np.full(condition.shape[1], 1 / condition.shape[1]), size = size).T
+    weights_control = rng.multinomial(control.shape[1], np.full(control.shape[1], 1 / control.shape[1]), size = size).T
+
+    return condition @ weights_condition / condition.shape[1] - control @ weights_control / control.shape[1]
+
+def _runBatches(function, shared, n_resamples, seed, n_jobs):
+
+    ##########################################################################
+    # Evaluate n_resamples permutations or bootstrap samples in batches, each
+    # with its own seed spawned from the given one, across n_jobs processes
+    ##########################################################################
+
+    sizes = [_BATCH_SIZE] * (n_resamples // _BATCH_SIZE)
+    if n_resamples % _BATCH_SIZE:
+        sizes.append(n_resamples % _BATCH_SIZE)
+    tasks = list(zip(seed.spawn(len(sizes)), sizes))
+
+    if n_jobs == 1:
+        _initWorker(shared)
+        try:
+            return [function(x) for x in tasks]
+        finally:
+            _WORKER.clear()
+
+    with ProcessPoolExecutor(max_workers = n_jobs, initializer = _initWorker, initargs = (shared,)) as executor:
+        return list(executor.map(function, tasks))
+
+def _permutationTest(control, condition, permutations, seed, n_jobs):
+
+    ##########################################################################
+    # Two-sided permutation p-value of the Mann-Whitney statistic of every
+    # row. Ranks do not change when labels are permuted, so each permutation
+    # is a product of the rank matrix with a column of labels
+    ##########################################################################
+
+    n_control = control.shape[1]
+    if n_control == 0 or condition.shape[1] == 0:
+        return np.ones(control.shape[0])
+
+    ranks = _averageRanks(np.concatenate([control, condition], axis = 1))
+    expected = n_control * (ranks.shape[1] + 1) / 2
+
+    # Tolerance so that permutations equal to the observed value are counted
+    observed = np.abs(ranks[:,:n_control].sum(axis = 1) - expected) - 1e-7
+
+    counts = _runBatches(_permutationBatch, {"ranks": ranks, "n_control": n_control,
+                                             "expected": expected, "observed": observed},
+                         permutations, seed, n_jobs)
+    p_value = (np.sum(counts, axis = 0) + 1) / (permutations + 1)
+
+    p_value[np.isnan(control).any(axis = 1) | np.isnan(condition).any(axis = 1)] = np.nan
+    return p_value
+
+def _bootstrapInterval(control, condition, bootstrap, seed, n_jobs, confidence = 0.95):
+
+    ##########################################################################
+    # Percentile bootstrap confidence interval of the difference of means
+    ##########################################################################
+
+    if control.shape[1] == 0 or condition.shape[1] == 0:
+        return np.full(control.shape[0], np.nan), np.full(control.shape[0], np.nan)
+
+    differences = np.concatenate(_runBatches(_bootstrapBatch, {"condition": condition, "control": control},
+                                             bootstrap, seed, n_jobs), axis = 1)
+    alpha = (1 - confidence) / 2 * 100
+    return np.percentile(differences, alpha, axis = 1), np.percentile(differences, 100 - alpha, axis = 1)
+
+def _differentialContrasts(scores, groups, contrasts, permutations = 0, bootstrap = 0, n_jobs = 1, random_seed = 0):
+
+    ##########################################################################
+    # Compare the scores (features x samples) of pairs of groups of samples
+    # for every feature: difference of means, Mann-Whitney p-value and its
+    # FDR adjustment. groups maps each group to its samples and contrasts is
+    # a list of (condition, control) pairs of groups. The scores are sorted
+    # and the group means computed once for all the contrasts. Optionally,
+    # adds permutation p-values and bootstrap confidence intervals of FC
+    ##########################################################################
+
+    involved = list(dict.fromkeys([x for pair in contrasts for x in pair]))
+    samples = [x for group in involved for x in groups[group]]
+    values = scores.loc[:,samples].to_numpy(dtype = np.float64)
+
+    columns = {}
+    means = {}
+    first = 0
+    for group in involved:
+        columns[group] = np.arange(first, first + len(groups[group]))
+        first += len(groups[group])
+
+        # Means skipping missing scores, as pandas does
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            means[group] = np.nanmean(values[:,columns[group]], axis = 1)
+
+    order = np.argsort(values, axis = 1)
+    sorted_values = np.take_along_axis(values, order, axis = 1)
+
+    from statsmodels.stats import multitest
+
+    results = {}
+    seeds = np.random.SeedSequence(random_seed).spawn(len(contrasts))
+    for (condition, control), seed in zip(contrasts, seeds):
+        p_value = _mannWhitneyUSorted(values, order, sorted_values, columns[control], columns[condition])
+        p_adj = multitest.fdrcorrection(p_value)
+        adjusted_results = pd.DataFrame(data = {'FC': means[condition] - means[control],
+                                                "p_Value": p_value,
+                                                "Adjusted_p_Value": p_adj[1]}, index = scores.index)
+        
+        seed_permutations, seed_bootstrap = seed.spawn(2)
+        if permutations > 0:
+            p_value = _permutationTest(values[:,columns[control]], values[:,columns[condition]],
+                                       permutations, seed_permutations, n_jobs)
+            adjusted_results['Permutation_p_Value'] = p_value
+            adjusted_results['Adjusted_Permutation_p_Value'] = multitest.fdrcorrection(p_value)[1]
+        if bootstrap > 0:
+            lower, upper = _bootstrapInterval(values[:,columns[control]], values[:,columns[condition]],
+                                              bootstrap, seed_bootstrap, n_jobs)
+            adjusted_results['FC_CI_Lower'] = lower
+            adjusted_results['FC_CI_Upper'] = upper
+        
+        results[(condition, control)] = adjusted_results
+
+    return results
+
+def _differentialTest(scores, condition_sample, control_sample):
+
+    ##########################################################################
+    # Compare the scores of the condition and control samples
+    ##########################################################################
+
+    results = _differentialContrasts(scores, {"condition": condition_sample, "control": control_sample},
+                                     [("condition", "control")])
+    return results[("condition", "control")]
+
+def _sortResults(adjusted_results):
+
+    ##########################################################################
+    # Sort by adjusted p-values and the absolute value of FC
+    ##########################################################################
+
+    adjusted_results = adjusted_results.assign(Absolute_FC = adjusted_results['FC'].abs())
+    sorted_adjusted_results = adjusted_results.sort_values(by=['Adjusted_p_Value', 'Absolute_FC'], ascending=[True, False])
+    sorted_adjusted_results = sorted_adjusted_results.drop(columns=['Absolute_FC'])
+
+    return sorted_adjusted_results
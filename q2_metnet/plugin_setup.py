@@ -1,14 +1,14 @@
 import qiime2.plugin
-from qiime2.plugin import  MetadataColumn, Categorical, Str, Bool, Choices
+from qiime2.plugin import  MetadataColumn, Categorical, Str, Bool, Int, Float, Range, Choices
 from q2_types.feature_table import FeatureTable, Frequency
 from q2_types.feature_data import FeatureData, Taxonomy
 
 import q2_metnet
-from q2_metnet._generateFeatures import generateFeatures
-from q2_metnet._functional_analysis import differentialSubSystems, differentialReactions, differentialExchanges
+from q2_metnet._generateFeatures import generateFeatures, appendFeatures, strain_weight_choices
+from q2_metnet._functional_analysis import differentialSubSystems, differentialReactions, differentialExchanges, analyzeFeatures, contrast_choices
 from q2_metnet._clustermap import plotClusteMap, clustermap_choices
 from q2_metnet._pca import plotPCA, pca_choices
-from q2_metnet._boxplot import plotBoxplot
+from q2_metnet._boxplot import plotBoxplot, plotBoxplots
 
 # cites = qiime2.plugin.Citations.load('citations.bib', package='q2_metnet')
 
@@ -38,18 +38,63 @@ plugin.methods.register_function(
     },
     parameters={'selection': Str,
                 'level': Str,
-                'input_interest':Bool},
+                'input_interest':Bool,
+                'chunk_size': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'strain_weights': Str % Choices(strain_weight_choices)},
     output_descriptions={'reactions': 'Reaction scores based on the samples and the taxonomy present in the selected reconstruction',
                          'subsystems': 'Subsystem scores based on the samples and the taxonomy present in the selected reconstruction',
                          'xmatrix': 'Frequency table after the normalization and filtering. The indexes are the strains in the AGORA/AGREDA models that correspond to the ASVs'
                          },
     parameter_descriptions={'selection': 'selection metabolic network among AGREDA, AGORAv103, AGORAv201',
                             'level': 'taxonomical level of interest: k (kingdom/domain), p (phylum), c (class), o (order), f (family), g (genus), s (species, default)',
-                            'input_interest':'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)'},
+                            'input_interest':'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)',
+                            'chunk_size': 'number of samples scored at once. Lower it to bound the memory used with large cohorts. 0 (default) scores all the samples at once',
+                            'n_jobs': 'number of threads computing the scores (1 by default). The scores are the same for any number of threads',
+                            'strain_weights': 'weights of the strains in the mean reaction presence of the strains matched to each taxon: the same for all of them (uniform, default), or the inverse of the number of genomes of their species, so that every species weighs the same (species)'},
     name='Reactions and subsystems features extraction',
     description='Extraction of the score related to each reaction and subsystem present in the metabolic reconstruction considering the taxonomy included in the samples'
 )
 
+# Register AppendFeatures function
+plugin.methods.register_function(
+    function=appendFeatures,
+    inputs={'frequency': FeatureTable[Frequency],
+            'taxa': FeatureData[Taxonomy],
+            'reactions': FeatureTable[Frequency],
+            'subsystems': FeatureTable[Frequency],
+            'xmatrix': FeatureTable[Frequency]
+    },
+    outputs=[('reactions', FeatureTable[Frequency]),
+             ('subsystems', FeatureTable[Frequency]),
+             ('xmatrix', FeatureTable[Frequency])
+             ],
+    input_descriptions={'frequency': 'table of frequency of the new samples',
+        'taxa': 'table of assigned taxonomy',
+        'reactions': 'reaction scores of the previous samples, produced by generateFeatures or appendFeatures',
+        'subsystems': 'subsystem scores of the previous samples, produced by generateFeatures or appendFeatures',
+        'xmatrix': 'Xmatrix of the previous samples, produced by generateFeatures or appendFeatures'
+    },
+    parameters={'selection': Str,
+                'level': Str,
+                'input_interest':Bool,
+                'chunk_size': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'strain_weights': Str % Choices(strain_weight_choices)},
+    output_descriptions={'reactions': 'Reaction scores of the previous and the new samples',
+                         'subsystems': 'Subsystem scores of the previous and the new samples',
+                         'xmatrix': 'Xmatrix of the previous and the new samples. Rows of lineages only present in the new samples are appended with new IDs'
+                         },
+    parameter_descriptions={'selection': 'selection metabolic network among AGREDA, AGORAv103, AGORAv201. It must be the one of the previous run',
+                            'level': 'taxonomical level of interest: k (kingdom/domain), p (phylum), c (class), o (order), f (family), g (genus), s (species, default). It must be the one of the previous run',
+                            'input_interest':'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)',
+                            'chunk_size': 'number of samples scored at once. 0 (default) scores all the new samples at once',
+                            'n_jobs': 'number of threads computing the scores (1 by default)',
+                            'strain_weights': 'weights of the strains in the mean reaction presence of the strains matched to each taxon: the same for all of them (uniform, default), or the inverse of the number of genomes of their species, so that every species weighs the same (species). It must be the one of the previous run'},
+    name='Append new samples to the reactions and subsystems features',
+    description='Score only the new samples of a cohort and append them to the reaction and subsystem scores and the Xmatrix of a previous run, instead of scoring the whole cohort again'
+)
+
 # Register DifferentialSubsystems function
 plugin.methods.register_function(
     function=differentialSubSystems,
@@ -58,11 +103,21 @@ plugin.methods.register_function(
     input_descriptions={'subsystems': 'table of frequency'},
     parameters={'metadata': MetadataColumn[Categorical],
                 'condition_name': Str,
-                'control_name': Str},
+                'control_name': Str,
+                'contrasts': Str % Choices(contrast_choices),
+                'permutations': Int % Range(0, None),
+                'bootstrap': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'random_seed': Int % Range(0, None)},
     output_descriptions={'differential_analysis': 'Differential analysis of the subsystems scores'},
     parameter_descriptions={'metadata': 'list of the condition states',
                             'condition_name': 'name of the condition category under analysis, taken from the metadata file',
-                            'control_name': 'name of the control category under analysis, taken from the metadata file'},
+                            'control_name': 'name of the control category under analysis, taken from the metadata file',
+                            'contrasts': 'comparisons to compute: condition against control (single, default), every category against the control (each_vs_control) or every pair of categories (all_pairwise). With several comparisons the results are stacked and labelled as "condition vs control | feature"',
+                            'permutations': 'number of label permutations of the permutation test of the Mann-Whitney statistic. Adds the Permutation_p_Value and Adjusted_Permutation_p_Value columns. 0 (default) skips the test',
+                            'bootstrap': 'number of bootstrap samples of the 95% confidence interval of FC. Adds the FC_CI_Lower and FC_CI_Upper columns. 0 (default) skips it',
+                            'n_jobs': 'number of processes evaluating the permutations and bootstrap samples (1 by default)',
+                            'random_seed': 'seed of the permutations and bootstrap samples. The results only depend on it, not on n_jobs'},
     name='Differential score analysis of the subsystems',
     description='Differential score analysis of the subsystems'
 )
@@ -76,12 +131,22 @@ plugin.methods.register_function(
     parameters={'metadata': MetadataColumn[Categorical],
                 'condition_name': Str,
                 'control_name': Str,
-                'selection_model': Str},
+                'selection_model': Str,
+                'contrasts': Str % Choices(contrast_choices),
+                'permutations': Int % Range(0, None),
+                'bootstrap': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'random_seed': Int % Range(0, None)},
     output_descriptions={'differential_analysis': 'Differential analysis of the reactions scores'},
     parameter_descriptions={'metadata': 'list of the condition states',
                             'condition_name': 'name of the condition category under analysis, taken from the metadata file',
                             'control_name': 'name of the control category under analysis, taken from the metadata file',
-                            'selection_model': 'selection of the metabolic reconstruction among AGREDA, AGORAv103, AGORAv201'},
+                            'selection_model': 'selection of the metabolic reconstruction among AGREDA, AGORAv103, AGORAv201',
+                            'contrasts': 'comparisons to compute: condition against control (single, default), every category against the control (each_vs_control) or every pair of categories (all_pairwise). With several comparisons the results are stacked and labelled as "condition vs control | feature"',
+                            'permutations': 'number of label permutations of the permutation test of the Mann-Whitney statistic. Adds the Permutation_p_Value and Adjusted_Permutation_p_Value columns. 0 (default) skips the test',
+                            'bootstrap': 'number of bootstrap samples of the 95% confidence interval of FC. Adds the FC_CI_Lower and FC_CI_Upper columns. 0 (default) skips it',
+                            'n_jobs': 'number of processes evaluating the permutations and bootstrap samples (1 by default)',
+                            'random_seed': 'seed of the permutations and bootstrap samples. The results only depend on it, not on n_jobs'},
     name='Differential score analysis of the subsystems',
     description='Differential score analysis of the subsystems'
 )
@@ -96,17 +161,80 @@ plugin.methods.register_function(
                 'condition_name': Str,
                 'control_name': Str,
                 'selection_model': Str, 
-                'input_interest': Bool},
+                'input_interest': Bool,
+                'contrasts': Str % Choices(contrast_choices),
+                'permutations': Int % Range(0, None),
+                'bootstrap': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'random_seed': Int % Range(0, None)},
     output_descriptions={'differential_analysis': 'Differential analysis of the exchanges scores'},
     parameter_descriptions={'metadata': 'list of the condition states',
                             'condition_name': 'name of the condition category under analysis, taken from the metadata file',
                             'control_name': 'name of the control category under analysis, taken from the metadata file',
                             'selection_model': 'selection of the metabolic reconstruction among AGREDA, AGORAv103, AGORAv201',
-                            'input_interest': 'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)'},
+                            'input_interest': 'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)',
+                            'contrasts': 'comparisons to compute: condition against control (single, default), every category against the control (each_vs_control) or every pair of categories (all_pairwise). With several comparisons the results are stacked and labelled as "condition vs control | feature"',
+                            'permutations': 'number of label permutations of the permutation test of the Mann-Whitney statistic. Adds the Permutation_p_Value and Adjusted_Permutation_p_Value columns. 0 (default) skips the test',
+                            'bootstrap': 'number of bootstrap samples of the 95% confidence interval of FC. Adds the FC_CI_Lower and FC_CI_Upper columns. 0 (default) skips it',
+                            'n_jobs': 'number of processes evaluating the permutations and bootstrap samples (1 by default)',
+                            'random_seed': 'seed of the permutations and bootstrap samples. The results only depend on it, not on n_jobs'},
     name='Differential score analysis of the subsystems',
     description='Differential score analysis of the subsystems'
 )
 
+# Register analyzeFeatures function
+plugin.methods.register_function(
+    function=analyzeFeatures,
+    inputs={'frequency': FeatureTable[Frequency],
+            'taxa': FeatureData[Taxonomy]
+    },
+    outputs=[('reactions', FeatureTable[Frequency]),
+             ('subsystems', FeatureTable[Frequency]),
+             ('xmatrix', FeatureTable[Frequency]),
+             ('differential_reactions', FeatureTable[Frequency]),
+             ('differential_subsystems', FeatureTable[Frequency]),
+             ('differential_exchanges', FeatureTable[Frequency])
+             ],
+    input_descriptions={'frequency': 'table of frequency',
+        'taxa': 'table of assigned taxonomy'
+    },
+    parameters={'metadata': MetadataColumn[Categorical],
+                'condition_name': Str,
+                'control_name': Str,
+                'selection': Str,
+                'level': Str,
+                'input_interest': Bool,
+                'contrasts': Str % Choices(contrast_choices),
+                'permutations': Int % Range(0, None),
+                'bootstrap': Int % Range(0, None),
+                'chunk_size': Int % Range(0, None),
+                'n_jobs': Int % Range(1, None),
+                'strain_weights': Str % Choices(strain_weight_choices),
+                'random_seed': Int % Range(0, None)},
+    output_descriptions={'reactions': 'Reaction scores based on the samples and the taxonomy present in the selected reconstruction',
+                         'subsystems': 'Subsystem scores based on the samples and the taxonomy present in the selected reconstruction',
+                         'xmatrix': 'Frequency table after the normalization and filtering. The indexes are the strains in the AGORA/AGREDA models that correspond to the ASVs',
+                         'differential_reactions': 'Differential analysis of the reactions scores',
+                         'differential_subsystems': 'Differential analysis of the subsystems scores',
+                         'differential_exchanges': 'Differential analysis of the exchange reactions scores'
+                         },
+    parameter_descriptions={'metadata': 'list of the condition states',
+                            'condition_name': 'name of the condition category under analysis, taken from the metadata file',
+                            'control_name': 'name of the control category under analysis, taken from the metadata file',
+                            'selection': 'selection metabolic network among AGREDA, AGORAv103, AGORAv201',
+                            'level': 'taxonomical level of interest: k (kingdom/domain), p (phylum), c (class), o (order), f (family), g (genus), s (species, default)',
+                            'input_interest': 'Boolean to define if focus on the exchanges that can be input (True, default) or all of them (False)',
+                            'contrasts': 'comparisons to compute: condition against control (single, default), every category against the control (each_vs_control) or every pair of categories (all_pairwise)',
+                            'permutations': 'number of label permutations of the permutation test of the Mann-Whitney statistic. 0 (default) skips the test',
+                            'bootstrap': 'number of bootstrap samples of the 95% confidence interval of FC. 0 (default) skips it',
+                            'chunk_size': 'number of samples scored at once. 0 (default) scores all the samples at once',
+                            'n_jobs': 'number of threads computing the scores and of processes evaluating the permutations and bootstrap samples (1 by default)',
+                            'strain_weights': 'weights of the strains in the mean reaction presence of the strains matched to each taxon: the same for all of them (uniform, default), or the inverse of the number of genomes of their species, so that every species weighs the same (species)',
+                            'random_seed': 'seed of the permutations and bootstrap samples'},
+    name='Features extraction and differential analyses in a single run',
+    description='Extraction of the reaction and subsystem scores followed by the differential analysis of the reactions, subsystems and exchange reactions, keeping the scores in memory between the steps'
+)
+
 # Register visualizer for the clustermap
 plugin.visualizers.register_function(
     function=plotClusteMap,
@@ -123,6 +251,9 @@ plugin.visualizers.register_function(
         'color_scheme': Str % Choices(clustermap_choices['color_scheme']),
         'xlabels': Bool, 
         'ylabels': Bool,
+        'max_features': Int % Range(0, None),
+        'feature_selection': Str % Choices(clustermap_choices['feature_selection']),
+        'cache_linkage': Bool,
     },
     name='Generate a clustermap representation of reactions or subsystems feature tables',
     description='Generate a clustermap representation of reactions or subsystems feature tables',
@@ -139,6 +270,9 @@ plugin.visualizers.register_function(
         'color_scheme': 'The matplotlib colorscheme to generate the clustermap.',
         'xlabels': 'boolean to choose if display xlabels', 
         'ylabels': 'boolean to choose if display ylabels',
+        'max_features': 'Maximum number of features to display, chosen by feature_selection. 0 (default) displays all of them.',
+        'feature_selection': 'How the features are chosen when there are more than max_features: the most variable ones (variance, default) or the ones with the lowest Kruskal-Wallis p-value between the groups of sample_metadata (significance).',
+        'cache_linkage': 'Store the hierarchical clustering of the table in the cache folder and reuse it when the same table is clustered with the same metric and method. False is the default.',
     }
 )
 
@@ -154,6 +288,10 @@ plugin.visualizers.register_function(
         'title': Str,
         'color_scheme': Str % Choices(pca_choices['color_scheme']),
         'point_label': Bool, 
+        'n_components': Int % Range(2, None),
+        'svd_solver': Str % Choices(pca_choices['svd_solver']),
+        'chunk_size': Int % Range(0, None),
+        'random_seed': Int % Range(0, None),
     },
     name='Generate a PCA representation of reactions or subsystems feature table',
     description='Generate a PCA representation of reactions or subsystems feature table.',
@@ -166,6 +304,10 @@ plugin.visualizers.register_function(
         'title': 'Optional title for the plot.',
         'color_scheme': 'The matplotlib colorscheme to generate the PCA',
         'point_label': 'boolean to choose if display labels for the PCA points', 
+        'n_components': 'Number of principal components computed and exported. The first two are plotted. 2 is the default.',
+        'svd_solver': 'Solver of the PCA: chosen by scikit-learn from the size of the table (auto, default), exact (full), randomized, or fitted by chunks of samples (incremental, approximate).',
+        'chunk_size': 'Number of samples of each chunk of the incremental solver. 0 (default) uses chunks of 1000 samples.',
+        'random_seed': 'Seed of the randomized solver. 0 is the default.',
     }
 )
 
@@ -197,3 +339,36 @@ plugin.visualizers.register_function(
         'control_name': 'Name of the control category, extracted from the metadata.', 
     }
 )
+
+# Register visualizer for the boxplots of the top differential features
+plugin.visualizers.register_function(
+    function=plotBoxplots,
+    inputs={
+        'table': FeatureTable[Frequency],
+        'differentialresults': FeatureTable[Frequency]
+    },
+    parameters={
+        'sample_metadata': MetadataColumn[Categorical],
+        'condition_name': Str,
+        'control_name': Str,
+        'top_k': Int % Range(1, None),
+        'fdr': Float % Range(0, 1, inclusive_end=True),
+        'per_page': Int % Range(1, None),
+        'n_jobs': Int % Range(1, None),
+    },
+    name='Generate the boxplots of the top differential reactions, exchanges or subsystems',
+    description='Generate the boxplots of the reactions, exchanges or subsystems with the lowest adjusted p-values in a differential analysis, comparing the scores in the condition to the ones in the control, in a single paged report.',
+    input_descriptions={
+        'table': 'The whole feature table.',
+        'differentialresults': 'Results of diffential expression analysis'
+    },
+    parameter_descriptions={
+        'sample_metadata': 'list of the condition states of interest.',
+        'condition_name': 'Name of the condition category, extracted from the metadata.',
+        'control_name': 'Name of the control category, extracted from the metadata.',
+        'top_k': 'Maximum number of features to plot, sorted by adjusted p-value and absolute fold-change. 50 is the default.',
+        'fdr': 'Maximum adjusted p-value of the features to plot. 0.05 is the default.',
+        'per_page': 'Number of boxplots of each page of the report. 10 is the default.',
+        'n_jobs': 'Number of processes drawing the boxplots. 1 is the default.',
+    }
+)
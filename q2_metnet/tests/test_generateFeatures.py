@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import biom
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import syntheticReconstruction, syntheticTaxonomy, syntheticFrequency
+from q2_metnet._inputFiles import _fillTaxa
+from q2_metnet._reference import _referenceFile
+
+# generateFeatures writes its tables to the file formats of q2-types
+HAS_Q2_TYPES = importlib.util.find_spec("q2_types") is not None
+if HAS_Q2_TYPES:
+    from q2_metnet._generateFeatures import generateFeatures, appendFeatures
+
+_DEPTH = {"k": 0, "p": 1, "c": 2, "o": 3, "f": 4, "g": 5, "s": 6}
+_COLUMN = {"k": "KINGDOM", "p": "PHYLUM", "c": "CLASS", "o": "ORDER", "f": "FAMILY", "g": "GENUS"}
+
+def _referenceFeatures(frequency, taxa, level):
+
+    ##########################################################################
+    # Scores of generateFeatures computed one ASV, lineage and reaction at a
+    # time, as the plugin did before the sparse engine: returns the reaction
+    # and subsystem scores (features x samples), with the subsystems by
+    # name, and the abundances of the matched lineages with their labels
+    ##########################################################################
+
+    species = pd.read_csv(_referenceFile("SYNTHETIC", "species"), sep = "\t")
+    rxnTax = pd.read_csv(_referenceFile("SYNTHETIC", "rxnTax"))
+    reactions = pd.read_csv(_referenceFile("SYNTHETIC", "reactions"))
+    class_exchange = pd.read_csv(_referenceFile("SYNTHETIC", "exchanges"), sep = "\t")
+    depth = _DEPTH[level]
+
+    # Lineage of each ASV at the level, summed and normalized per sample
+    counts = frequency.to_dataframe(dense = True)
+    lineages = {}
+    for asv in counts.index:
+        taxon = _fillTaxa(taxa.Taxon[asv]).replace("NA", "")
+        levels = [x.strip() for x in pd.Series([taxon]).str.replace(r"\w__", "", regex = True)
+                                                          .str.replace(r"[\[\]]", "", regex = True)[0].split(";")]
+        if levels[depth] != "":
+            lineages[asv] = ";".join(levels[:depth + 1])
+    counts = counts.loc[list(lineages.keys())]
+    unique = list(dict.fromkeys(lineages.values()))
+    collapsed = pd.DataFrame([counts.loc[[x for x in counts.index if lineages[x] == y]].sum(axis = 0) for y in unique])
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        collapsed = collapsed / collapsed.sum(axis = 0)
+
+    # Strains matched to each lineage and mean presence of each reaction
+    presence, abundances, labels = [], [], []
+    for position, lineage in enumerate(unique):
+        names = lineage.split(";")
+        if level == "s":
+            name = " ".join([names[depth - 1], names[depth]])
+            present = [x for x in species.index if name in species["AGORA.NAMES"][x] or name in species["NCBI.NAMES"][x]]
+        else:
+            present = [x for x in species.index
+                       if isinstance(species[_COLUMN[level]][x], str) and names[depth] in species[_COLUMN[level]][x]]
+        if not present:
+            continue
+        # 1-based positions of the columns, wrapped around as in iloc
+        presence.append(rxnTax.iloc[:,[x - 1 for x in present]].mean(axis = 1).values)
+        abundances.append(collapsed.iloc[position].values)
+        labels.append(";".join(["M_ASV%d" % position] + list(species.loc[present, "AGORA.NAMES"].values)))
+
+    abundances = np.array(abundances)
+    scores = np.array(presence).T @ abundances
+    reaction_scores = pd.DataFrame(scores, index = reactions.rxnID.values, columns = counts.columns)
+
+    # Each subsystem is the mean of the scores of its reactions; exchange
+    # reactions take their class as subsystem
+    membership = {}
+    for idx_rxn, rxn in enumerate(reactions.rxnID.values):
+        classes = class_exchange.Class[class_exchange.rxnID == rxn].values
+        subsystem = classes[0] if len(classes) else reactions.subSystems[idx_rxn]
+        if isinstance(subsystem, str):
+            for each in subsystem.split(";"):
+                membership.setdefault(each, set()).add(idx_rxn)
+    subsystem_scores = pd.DataFrame([scores[sorted(x),:].sum(axis = 0) / len(x) for x in membership.values()],
+                                    index = list(membership.keys()), columns = counts.columns)
+
+    xmatrix = pd.DataFrame(abundances, index = labels, columns = counts.columns)
+    return reaction_scores, subsystem_scores, xmatrix
+
+def _scoresFrame(table):
+
+    ##########################################################################
+    # Scores (features x samples) of an output of generateFeatures
+    ##########################################################################
+
+    if not isinstance(table, biom.Table):
+        table = biom.load_table(str(table))
+    return table.to_dataframe(dense = True).T
+
+class SyntheticTestCase(unittest.TestCase):
+
+    ##########################################################################
+    # Synthetic reconstruction whose species are labelled from 0, so that
+    # the first strain takes the last column of the reaction-by-taxon matrix
+    # (labels - 1 wraps around), and a cohort with a sample without counts
+    ##########################################################################
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp(prefix = "q2-metnet-tests-")
+        cls.cache_dir = os.environ.get("Q2_METNET_CACHE_DIR")
+        os.environ["Q2_METNET_CACHE_DIR"] = os.path.join(cls.folder, "cache")
+
+        files = syntheticReconstruction(os.path.join(cls.folder, "SYNTHETIC"), n_reactions = 400, n_strains = 120,
+                                        n_exchanges = 40, n_subsystems = 20)
+        species = pd.read_csv(files["species"], sep = "\t")
+        species.index = range(len(species.index))
+        species.to_csv(files["species"], sep = "\t", index_label = False)
+
+        cls.taxa = syntheticTaxonomy("SYNTHETIC", 200, seed = 1)
+        frequency = syntheticFrequency(200, 24, 0.1, seed = 1)
+        counts = frequency.matrix_data.toarray()
+        counts[:,5] = 0
+        cls.frequency = biom.Table(counts, observation_ids = frequency.ids(axis = 'observation'),
+                                   sample_ids = frequency.ids(axis = 'sample'))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.cache_dir is None:
+            os.environ.pop("Q2_METNET_CACHE_DIR", None)
+        else:
+            os.environ["Q2_METNET_CACHE_DIR"] = cls.cache_dir
+        shutil.rmtree(cls.folder, ignore_errors = True)
+
+@unittest.skipUnless(HAS_Q2_TYPES, "q2-types is not installed")
+class GenerateFeaturesTests(SyntheticTestCase):
+
+    def assertSameFeatures(self, level):
+        reactions, subsystems, xmatrix = generateFeatures(self.frequency, self.taxa, selection = "SYNTHETIC",
+                                                          level = level)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            expected_reactions, expected_subsystems, expected_xmatrix = _referenceFeatures(self.frequency, self.taxa, level)
+
+        reactions = _scoresFrame(reactions)
+        self.assertEqual(list(reactions.index), list(expected_reactions.index))
+        self.assertEqual(list(reactions.columns), list(expected_reactions.columns))
+        np.testing.assert_allclose(reactions.values, expected_reactions.values, rtol = 1e-12, atol = 1e-15)
+
+        # The subsystems are labelled "S<position> | name", sorted by name
+        subsystems = _scoresFrame(subsystems)
+        names = [x.split(" | ", 1)[1] for x in subsystems.index]
+        self.assertEqual(names, sorted(expected_subsystems.index))
+        self.assertEqual(list(subsystems.index), ["S%d | %s" % (x, y) for x, y in enumerate(names)])
+        np.testing.assert_allclose(subsystems.values, expected_subsystems.loc[names].values, rtol = 1e-12, atol = 1e-15)
+
+        xmatrix = _scoresFrame(xmatrix)
+        self.assertEqual(list(xmatrix.index), list(expected_xmatrix.index))
+        np.testing.assert_allclose(xmatrix.values, expected_xmatrix.values, rtol = 1e-12, atol = 0)
+
+        # The sample without counts has undefined scores
+        self.assertTrue(np.isnan(reactions.iloc[:,5]).all())
+        self.assertTrue(np.isnan(subsystems.iloc[:,5]).all())
+        self.assertFalse(np.isnan(np.delete(reactions.values, 5, axis = 1)).any())
+
+    def test_species(self):
+        self.assertSameFeatures("s")
+
+    def test_genus(self):
+        self.assertSameFeatures("g")
+
+    def test_family(self):
+        self.assertSameFeatures("f")
+
+    def test_wrapped_strain(self):
+        # The first strain is matched at the species level, so its reactions
+        # are taken from the last column of the reaction-by-taxon matrix
+        species = pd.read_csv(_referenceFile("SYNTHETIC", "species"), sep = "\t")
+        name = species["NCBI.NAMES"][0].split(" ")
+        self.assertTrue(any(x.endswith("g__%s; s__%s" % tuple(name)) for x in self.taxa.Taxon.values))
+
+@unittest.skipUnless(HAS_Q2_TYPES, "q2-types is not installed")
+class ChunkedFeaturesTests(SyntheticTestCase):
+
+    ##########################################################################
+    # Chunked, threaded and appended runs give the same tables as scoring
+    # all the samples at once
+    ##########################################################################
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.expected = [_scoresFrame(x) for x in generateFeatures(cls.frequency, cls.taxa, selection = "SYNTHETIC",
+                                                                  level = "g")]
+
+    def assertSameTables(self, outputs):
+        for table, expected in zip(outputs, self.expected):
+            table = _scoresFrame(table)
+            self.assertEqual(list(table.index), list(expected.index))
+            self.assertEqual(list(table.columns), list(expected.columns))
+            np.testing.assert_array_equal(table.values, expected.values)
+
+    def test_chunks(self):
+        # Chunks of one sample, chunks that do not divide the cohort, one
+        # chunk and chunks larger than the cohort
+        for chunk_size in [1, 5, 24, 30]:
+            with self.subTest(chunk_size = chunk_size):
+                self.assertSameTables(generateFeatures(self.frequency, self.taxa, selection = "SYNTHETIC", level = "g",
+                                                       chunk_size = chunk_size))
+
+    def test_threads(self):
+        for chunk_size in [0, 7]:
+            with self.subTest(chunk_size = chunk_size):
+                self.assertSameTables(generateFeatures(self.frequency, self.taxa, selection = "SYNTHETIC", level = "g",
+                                                       chunk_size = chunk_size, n_jobs = 3))
+
+    def test_append(self):
+        samples = list(self.frequency.ids(axis = 'sample'))
+        previous = generateFeatures(self.frequency.filter(samples[:15], inplace = False), self.taxa,
+                                    selection = "SYNTHETIC", level = "g", chunk_size = 4)
+        previous = [x if isinstance(x, biom.Table) else biom.load_table(str(x)) for x in previous]
+        self.assertSameTables(appendFeatures(self.frequency.filter(samples[15:], inplace = False), self.taxa, *previous,
+                                             selection = "SYNTHETIC", level = "g", chunk_size = 4, n_jobs = 2))
+
+    def test_no_samples(self):
+        frequency = self.frequency.filter([], inplace = False)
+        with self.assertRaisesRegex(ValueError, "no samples"):
+            generateFeatures(frequency, self.taxa, selection = "SYNTHETIC", level = "g")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import subprocess
+import sys
+import unittest
+
+# Modules that registering the plugin must not load: they are only needed
+# when an action runs
+HEAVY_MODULES = ["scipy.stats", "statsmodels", "sklearn", "seaborn", "matplotlib", "q2templates", "pkg_resources"]
+
+# Seconds that importing plugin_setup may add to importing QIIME 2 itself
+IMPORT_BUDGET = 1.0
+
+# Modules QIIME 2 loads before it imports any plugin
+BASELINE = "import qiime2.plugin, q2_types.feature_table, q2_types.feature_data"
+
+def _importTime(statement):
+    code = "import time; start = time.perf_counter(); %s; print(time.perf_counter() - start)" % statement
+    return float(subprocess.check_output([sys.executable, "-c", code]).decode().strip())
+
+def _heavyModules():
+
+    ##########################################################################
+    # Heavy modules loaded by plugin_setup that QIIME 2 had not loaded yet
+    ##########################################################################
+
+    code = ("import sys; %s; before = set(sys.modules); import q2_metnet.plugin_setup; "
+            "print(' '.join(x for x in %r if x in sys.modules and x not in before))" % (BASELINE, HEAVY_MODULES))
+    return subprocess.check_output([sys.executable, "-c", code]).decode().split()
+
+def _hasQiime():
+    try:
+        return importlib.util.find_spec("qiime2.plugin") is not None and importlib.util.find_spec("q2_types") is not None
+    except ImportError:
+        return False
+
+@unittest.skipUnless(_hasQiime(), "QIIME 2 and q2-types are not installed")
+class ImportPluginTests(unittest.TestCase):
+
+    ##########################################################################
+    # QIIME 2 imports the plugin every time it lists the plugins (qiime
+    # --help, qiime info, ...), so registering it must stay fast
+    ##########################################################################
+
+    def test_no_heavy_modules(self):
+        heavy = _heavyModules()
+        self.assertEqual(heavy, [], "Registering the plugin loads %s" % ", ".join(heavy))
+
+    def test_import_budget(self):
+        baseline = min(_importTime(BASELINE) for x in range(3))
+        plugin = min(_importTime("import q2_metnet.plugin_setup") for x in range(3))
+        self.assertLessEqual(plugin - baseline, IMPORT_BUDGET,
+                             "Registering the plugin takes %.2f s on top of QIIME 2 (budget: %.2f s)" %
+                             (plugin - baseline, IMPORT_BUDGET))
+
+if __name__ == "__main__":
+    unittest.main()
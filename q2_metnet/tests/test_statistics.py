@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+from statsmodels.stats import multitest
+from q2_metnet._statistics import _mannWhitneyU, _mannWhitneyUSorted, _asymptoticPValue, _kruskalWallis, \
+    _differentialContrasts
+
+def _scores(n_rows, n_cols, seed = 0):
+
+    ##########################################################################
+    # Random scores with tied values, rows with a single value and rows
+    # with missing scores
+    ##########################################################################
+
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(2, size = (n_rows, n_cols))
+    values[n_rows // 4:n_rows // 2] = np.round(values[n_rows // 4:n_rows // 2])
+    values[0] = 1.5
+    values[1] = 0
+    values[2, 3] = np.nan
+    return values
+
+def _scipyMannWhitneyU(control, condition):
+
+    ##########################################################################
+    # One call to stats.mannwhitneyu per row, as the differential methods
+    # did before the vectorised engine
+    ##########################################################################
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return np.array([stats.mannwhitneyu(x, y).pvalue for x, y in zip(control, condition)])
+
+class MannWhitneyUTests(unittest.TestCase):
+
+    def assertSamePValues(self, control, condition):
+        np.testing.assert_allclose(_mannWhitneyU(control, condition), _scipyMannWhitneyU(control, condition),
+                                   rtol = 1e-12, atol = 0, equal_nan = True)
+
+    def test_exact_small_groups(self):
+        # Groups of 8 or fewer samples without ties take the exact p-value
+        values = _scores(40, 13)
+        self.assertSamePValues(values[:,:5], values[:,5:])
+        self.assertSamePValues(values[:,:8], values[:,8:])
+
+    def test_asymptotic_large_groups(self):
+        values = _scores(40, 30, seed = 1)
+        self.assertSamePValues(values[:,:12], values[:,12:])
+
+    def test_one_small_group(self):
+        values = _scores(40, 25, seed = 2)
+        self.assertSamePValues(values[:,:3], values[:,3:])
+
+    def test_ties(self):
+        values = np.round(_scores(40, 16, seed = 3))
+        self.assertSamePValues(values[:,:6], values[:,6:])
+
+    def test_all_equal_rows(self):
+        values = np.full((3, 10), 2.0)
+        np.testing.assert_array_equal(_mannWhitneyU(values[:,:4], values[:,4:]), np.ones(3))
+        self.assertSamePValues(values[:,:4], values[:,4:])
+
+    def test_missing_scores(self):
+        values = _scores(10, 12, seed = 4)
+        p_value = _mannWhitneyU(values[:,:6], values[:,6:])
+        self.assertTrue(np.isnan(p_value[2]))
+        self.assertFalse(np.isnan(np.delete(p_value, 2)).any())
+
+    def test_empty_group(self):
+        # Undefined test: a p-value of 1, as the differential methods did
+        # when stats.mannwhitneyu raised an error
+        values = _scores(5, 6)
+        np.testing.assert_array_equal(_mannWhitneyU(values[:,:0], values), np.ones(5))
+        np.testing.assert_array_equal(_mannWhitneyU(values, values[:,:0]), np.ones(5))
+
+    def test_sorted_subset_of_columns(self):
+        # Testing two sets of columns of a larger matrix, sorted once
+        values = _scores(30, 20, seed = 5)
+        order = np.argsort(values, axis = 1)
+        sorted_values = np.take_along_axis(values, order, axis = 1)
+        control, condition = np.array([1, 4, 7, 9, 15]), np.array([0, 2, 3, 11, 12, 18, 19])
+        np.testing.assert_allclose(_mannWhitneyUSorted(values, order, sorted_values, control, condition),
+                                   _scipyMannWhitneyU(values[:,control], values[:,condition]),
+                                   rtol = 1e-12, atol = 0, equal_nan = True)
+
+    def test_asymptotic_p_value(self):
+        rng = np.random.default_rng(6)
+        control, condition = rng.normal(size = (20, 15)), rng.normal(size = (20, 17))
+        U1 = stats.mannwhitneyu(control, condition, axis = 1, method = "asymptotic").statistic
+        np.testing.assert_allclose(_asymptoticPValue(U1, 15, 17, np.zeros(20)),
+                                   stats.mannwhitneyu(control, condition, axis = 1, method = "asymptotic").pvalue,
+                                   rtol = 1e-12, atol = 0)
+
+class KruskalWallisTests(unittest.TestCase):
+
+    def test_groups(self):
+        values = _scores(40, 24, seed = 7)
+        labels = np.array(["a", "b", "c"] * 8)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            expected = np.array([stats.kruskal(*[x[labels == y] for y in "abc"]).pvalue for x in values])
+        p_value = _kruskalWallis(values, labels)
+
+        # A single value in the row: a p-value of 1 instead of nan
+        np.testing.assert_array_equal(p_value[:2], np.ones(2))
+        np.testing.assert_allclose(p_value[2:], expected[2:], rtol = 1e-12, atol = 0, equal_nan = True)
+        self.assertTrue(np.isnan(p_value[2]))
+
+    def test_single_group(self):
+        values = _scores(5, 6)
+        np.testing.assert_array_equal(_kruskalWallis(values, ["a"] * 6), np.ones(5))
+
+class DifferentialContrastsTests(unittest.TestCase):
+
+    def setUp(self):
+        values = _scores(60, 18, seed = 8)
+        self.samples = ["sample%d" % x for x in range(18)]
+        self.scores = pd.DataFrame(values, index = ["rxn%d" % x for x in range(60)], columns = self.samples)
+        self.groups = {"a": self.samples[:6], "b": self.samples[6:13], "c": self.samples[13:]}
+
+    def test_contrasts(self):
+        contrasts = [("a", "b"), ("c", "b"), ("c", "a")]
+        results = _differentialContrasts(self.scores, self.groups, contrasts)
+
+        for condition, control in contrasts:
+            control_scores = self.scores.loc[:,self.groups[control]]
+            condition_scores = self.scores.loc[:,self.groups[condition]]
+            p_value = _scipyMannWhitneyU(control_scores.values, condition_scores.values)
+
+            result = results[(condition, control)]
+            self.assertEqual(list(result.index), list(self.scores.index))
+            np.testing.assert_allclose(result.p_Value.values, p_value, rtol = 1e-12, atol = 0, equal_nan = True)
+            np.testing.assert_allclose(result.Adjusted_p_Value.values, multitest.fdrcorrection(p_value)[1],
+                                       rtol = 1e-12, atol = 0, equal_nan = True)
+            np.testing.assert_allclose(result.FC.values, condition_scores.mean(axis = 1) - control_scores.mean(axis = 1),
+                                       rtol = 1e-12, atol = 1e-15)
+
+    def test_missing_group(self):
+        groups = dict(self.groups, d = [])
+        result = _differentialContrasts(self.scores, groups, [("a", "d")])[("a", "d")]
+        np.testing.assert_array_equal(result.p_Value.values, np.ones(60))
+        self.assertTrue(np.isnan(result.FC.values).all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,7 +20,8 @@ setup(
             'data/*/*',
             '_clustermap/assets/index.html',
             '_pca/assets/index.html',
-            '_boxplot/assets/index.html'
+            '_boxplot/assets/index.html',
+            '_boxplot/assets/batch/index.html'
         ]
     }
 )